@@ -0,0 +1,401 @@
+import itertools
+import logging
+import threading
+import weakref
+from PIL import Image
+from PyQt6 import QtCore
+from PyQt6.QtCore import QPoint
+from tiles import TileGrid
+from tiled_filter import filter_halo, executor, run_filter
+
+# versions of node outputs, a tile gets a new one every time it is computed
+_versions = itertools.count(1)
+
+
+class FilterNode:
+    """
+    A filter of an adjustment stack and the tiles it produced.
+
+    Nodes do not change once created, editing a filter replaces its node so
+    history events can keep the old one. Output tiles are cached per image
+    together with a signature of the input tiles they were computed from.
+    """
+    def __init__(self, image_filter):
+        self.image_filter = image_filter
+        self.halo = filter_halo(image_filter)
+        self.version = next(_versions)
+        # image -> {key: (signature, version, tile)}
+        self._tiles = weakref.WeakKeyDictionary()
+        # image -> (signature, filtered image), for filters needing the whole image
+        self._whole = weakref.WeakKeyDictionary()
+        # the caches are filled by the renderer thread and pruned by the GUI thread
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_tiles"]
+        del state["_whole"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._tiles = weakref.WeakKeyDictionary()
+        self._whole = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        # versions are only unique within a session
+        self.version = next(_versions)
+
+    def input_box(self, image, key):
+        """
+        Return the box of input pixels needed to compute a tile, clipped to
+        the image like filtering the whole image would.
+        """
+        if self.halo is None:
+            return image.rect
+        left, top, right, bottom = image.tiles.tile_rect(key)
+        image_left, image_top, image_right, image_bottom = image.rect
+        return (
+            max(image_left, left - self.halo),
+            max(image_top, top - self.halo),
+            min(image_right, right + self.halo),
+            min(image_bottom, bottom + self.halo)
+        )
+
+    def input_keys(self, image, keys):
+        if self.halo == 0:
+            return set(keys)
+        if self.halo is None:
+            return set(image.tiles.keys_in_box(image.rect))
+        inputs = set()
+        for key in keys:
+            inputs.update(image.tiles.keys_in_box(self.input_box(image, key)))
+        return inputs
+
+    def run(self, image, keys, source, upstream):
+        """
+        Return {key: (version, tile)} of the output tiles for keys.
+
+        :param source: {key: (version, tile)} of the input tiles, it must
+            cover input_keys(image, keys)
+        :param upstream: version of the node producing source, 0 when source
+            holds the image tiles
+        """
+        results = {}
+        missing = []
+        with self._lock:
+            tiles = self._tiles.setdefault(image, {})
+        for key in keys:
+            box = self.input_box(image, key)
+            inputs = image.tiles.keys_in_box(box)
+            signature = (upstream, box, tuple(source[input_key][0] for input_key in inputs))
+            cached = tiles.get(key)
+            if cached is not None and cached[0] == signature:
+                results[key] = cached[1:]
+            else:
+                missing.append((key, box, inputs, signature))
+        if not missing:
+            return results
+
+        whole = None
+        if self.halo is None:
+            # every tile has the same signature, filter the image once for all of them
+            cached = self._whole.get(image)
+            if cached is not None and cached[0] == missing[0][3]:
+                whole = cached[1]
+            else:
+                _key, box, inputs, signature = missing[0]
+                whole = self.filter_box(image, box, inputs, source)
+                with self._lock:
+                    self._whole[image] = (signature, whole)
+
+        def compute(item):
+            key, box, inputs, signature = item
+            filtered = whole if whole is not None else self.filter_box(image, box, inputs, source)
+            return key, signature, self.crop_tile(image, key, box, filtered)
+
+        # PIL releases the GIL while filtering so the tiles are computed in parallel
+        for key, signature, tile in executor().map(compute, missing):
+            version = next(_versions)
+            tiles[key] = (signature, version, tile)
+            results[key] = (version, tile)
+        return results
+
+    def filter_box(self, image, box, inputs, source):
+        left, top, right, bottom = box
+        region = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        for key in inputs:
+            tile = source[key][1]
+            if tile is not None:
+                tile_left, tile_top, _, _ = image.tiles.tile_rect(key)
+                region.paste(tile, (tile_left - left, tile_top - top))
+        filtered = run_filter(region, self.image_filter)
+        if filtered.mode != "RGBA":
+            filtered = filtered.convert("RGBA")
+        return filtered
+
+    def crop_tile(self, image, key, box, filtered):
+        """
+        Cut the pixels of a tile out of a filtered box, returns None when
+        the tile is fully transparent.
+        """
+        tile_left, tile_top, tile_right, tile_bottom = image.tiles.tile_rect(key)
+        image_left, image_top, image_right, image_bottom = image.rect
+        left, top = max(tile_left, image_left), max(tile_top, image_top)
+        right, bottom = min(tile_right, image_right), min(tile_bottom, image_bottom)
+        size = image.tiles.tile_size
+        tile = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        tile.paste(
+            filtered.crop((left - box[0], top - box[1], right - box[0], bottom - box[1])),
+            (left - tile_left, top - tile_top)
+        )
+        if tile.getchannel("A").getbbox() is None:
+            return None
+        return tile
+
+    def forget(self, images):
+        """
+        Drop the cached tiles of images other than images, images which are
+        gone are dropped on their own.
+        """
+        with self._lock:
+            for cache in (self._tiles, self._whole):
+                for image in [image for image in cache.keys() if image not in images]:
+                    cache.pop(image, None)
+
+
+class AdjustmentOutput:
+    """
+    The filtered tiles of one image, as shown on the canvas.
+    """
+    def __init__(self, result):
+        self.result = result
+        # key -> node output version of the tile in result, None for an unfiltered placeholder
+        self.versions = {}
+        # signature of the last evaluation handed to the renderer
+        self.requested = None
+        # {key: (version, tile)} computed by the renderer and not applied yet
+        self.finished = {}
+
+
+class AdjustmentStack:
+    """
+    Non-destructive filters of a layer.
+
+    The layer images are left untouched, the filters are run lazily on the
+    tiles which are drawn. Each node caches its output tiles, so editing the
+    image only recomputes the tiles around the edit and replacing a node
+    only recomputes that node and the nodes after it. The node list is
+    replaced rather than modified so history events can hold on to it.
+    """
+    def __init__(self, nodes=None):
+        self.nodes = list(nodes or [])
+        # image -> AdjustmentOutput
+        self._outputs = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_outputs"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._outputs = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def add(self, image_filter):
+        self.nodes = self.nodes + [FilterNode(image_filter)]
+
+    def replace(self, index, image_filter):
+        nodes = list(self.nodes)
+        nodes[index] = FilterNode(image_filter)
+        self.nodes = nodes
+
+    def remove(self, index):
+        self.nodes = self.nodes[:index] + self.nodes[index + 1:]
+
+    def needed_keys(self, nodes, image, keys):
+        """
+        Return the keys every node reads to produce keys, the first entry
+        holds the image tiles.
+        """
+        needed = [set(keys)]
+        for node in reversed(nodes):
+            needed.append(node.input_keys(image, needed[-1]))
+        needed.reverse()
+        return needed
+
+    def evaluate(self, nodes, image, needed, source):
+        """
+        Return {key: (version, tile)} of image after nodes, for the keys of
+        needed[-1].
+
+        :param source: {key: (version, tile)} of the image tiles of needed[0]
+        """
+        upstream = 0
+        for node, wanted in zip(nodes, needed[1:]):
+            source = node.run(image, wanted, source, upstream)
+            upstream = node.version
+        return source
+
+    def flatten(self, image, box=None, nodes=None, tiles=None):
+        """
+        Return an ImageData of image with the filters applied, computed on
+        the calling thread, holding the tiles which intersect box (the whole
+        image by default). Tiles the renderer already computed come from the
+        node caches and the tiles keep the version of the node output, so
+        tiles which did not change keep their version.
+
+        :param nodes: the nodes to apply, the current nodes by default
+        :param tiles: a copy of image.tiles to read the pixels from, taken
+            earlier with the same image bounds
+        """
+        nodes = self.nodes if nodes is None else nodes
+        tiles = image.tiles if tiles is None else tiles
+        box = image.rect if box is None else box
+        needed = self.needed_keys(nodes, image, image.tiles.keys_in_box(box))
+        source = {key: (tiles.tile_version(key), tile) for key, tile in tiles.snapshot(needed[0]).items()}
+        results = self.evaluate(nodes, image, needed, source)
+        flat = TileGrid(image.tiles.tile_size)
+        for key in needed[-1]:
+            version, tile = results[key]
+            if tile is not None:
+                flat.tiles[key] = tile
+                flat.versions[key] = version
+        flat.version = next(_versions)
+        return type(image)(QPoint(image.position), tiles=flat, size=image.size)
+
+    def output(self, image, box, renderer, level=0):
+        """
+        Return an ImageData with the filtered tiles of image which intersect
+        box, tiles outside of box may be stale. The box is widened to whole
+        tiles of the pyramid level so zoomed out views can be drawn.
+
+        Tiles which are out of date are computed by renderer in the
+        background, which emits ready once they can be picked up by the next
+        call. Until then the previous filtered tiles are returned, or the
+        unfiltered tiles for tiles which were never filtered.
+        """
+        size = image.tiles.tile_size << level
+        image_left, image_top, image_right, image_bottom = image.rect
+        box = (
+            max(image_left, box[0] // size * size),
+            max(image_top, box[1] // size * size),
+            min(image_right, -(-box[2] // size) * size),
+            min(image_bottom, -(-box[3] // size) * size)
+        )
+        entry = self._outputs.get(image)
+        if entry is None:
+            entry = AdjustmentOutput(
+                type(image)(QPoint(image.position), tiles=TileGrid(image.tiles.tile_size), size=image.size)
+            )
+            self._outputs[image] = entry
+        with self._lock:
+            finished, entry.finished = entry.finished, {}
+        self.apply(entry, finished)
+
+        nodes = self.nodes
+        keys = image.tiles.keys_in_box(box)
+        needed = self.needed_keys(nodes, image, keys)
+        signature = (
+            tuple(node.version for node in nodes),
+            frozenset((key, image.tiles.tile_version(key)) for key in needed[0])
+        )
+        if signature != entry.requested:
+            entry.requested = signature
+            # the renderer reads the tiles as they are now, they are no longer written in place
+            tiles = image.tiles.snapshot(needed[0])
+            source = {key: (image.tiles.tile_version(key), tile) for key, tile in tiles.items()}
+            renderer.submit(self, image, nodes, needed, source)
+            for key in keys:
+                if key not in entry.versions:
+                    entry.result.tiles.set_tile(key, tiles.get(key))
+                    entry.versions[key] = None
+        return entry.result
+
+    def finish(self, image, results):
+        """
+        Hand tiles computed by the renderer to the next output() call.
+        """
+        entry = self._outputs.get(image)
+        if entry is None:
+            return
+        with self._lock:
+            entry.finished.update(results)
+
+    def fail(self, image):
+        """
+        Forget the evaluation handed to the renderer after it failed, so the
+        next output() call submits it again.
+        """
+        entry = self._outputs.get(image)
+        if entry is not None:
+            entry.requested = None
+
+    def apply(self, entry, results):
+        for key, (version, tile) in results.items():
+            if entry.versions.get(key) != version:
+                entry.versions[key] = version
+                entry.result.tiles.set_tile(key, tile)
+
+    def prune(self, images):
+        """
+        Drop everything cached for images which are no longer on the layer.
+        """
+        stale = [image for image in self._outputs.keys() if image not in images]
+        if not stale:
+            return
+        for image in stale:
+            self._outputs.pop(image, None)
+        for node in self.nodes:
+            node.forget(images)
+
+
+class AdjustmentRenderer(QtCore.QObject):
+    """
+    Evaluates adjustment stacks on a worker thread so filters never run
+    while the canvas paints.
+
+    Only the latest evaluation of an image matters, an evaluation waiting
+    to run is replaced by the next submit for the same stack and image.
+    ready is emitted after an evaluation finished, failed with the error
+    message after an evaluation raised.
+    """
+    ready = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.thread = None
+
+    def submit(self, stack, image, nodes, needed, source):
+        with self.condition:
+            self.jobs[(stack, image)] = (nodes, needed, source)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="adjustments", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                (stack, image), (nodes, needed, source) = self.jobs.popitem()
+            try:
+                results = stack.evaluate(nodes, image, needed, source)
+            except Exception as e:
+                logging.getLogger().error(f"Adjustment failed: {e}")
+                # retried when the image is painted again
+                stack.fail(image)
+                self.failed.emit(str(e))
+                continue
+            stack.finish(image, {key: results[key] for key in needed[-1]})
+            self.ready.emit()
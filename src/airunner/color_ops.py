@@ -0,0 +1,95 @@
+import numpy as np
+from PIL import Image
+
+# weights PIL uses to convert RGB to L
+LUMA = np.array([0.299, 0.587, 0.114])
+
+# point table leaving the alpha channel of an RGBA image as it is
+ALPHA_IDENTITY = list(range(256))
+
+
+class ColorPipeline:
+    """
+    A chain of per-pixel color adjustments applied in a single pass.
+
+    Stages are affine color matrices (3x4, the last column is the offset)
+    and per-channel lookup tables (3x256). Adjacent matrices are multiplied
+    together and adjacent tables are composed when the pipeline is built,
+    so a stack of adjustments usually ends up as a single stage which is
+    one pass over the pixels. Intermediate results are not clipped. Alpha
+    is never touched.
+    """
+    def __init__(self, stages=None):
+        self.stages = []
+        for kind, value in stages or []:
+            if self.stages and self.stages[-1][0] == kind:
+                previous = self.stages[-1][1]
+                if kind == "matrix":
+                    # apply previous first: value @ [previous; 0 0 0 1]
+                    value = value[:, :3] @ previous + np.hstack((np.zeros((3, 3)), value[:, 3:]))
+                else:
+                    value = np.stack([value[channel][previous[channel]] for channel in range(3)])
+                self.stages[-1] = (kind, value)
+            else:
+                self.stages.append((kind, value))
+
+    def __len__(self):
+        return len(self.stages)
+
+    @staticmethod
+    def matrix(matrix, offset=(0, 0, 0)):
+        affine = np.zeros((3, 4))
+        affine[:, :3] = matrix
+        affine[:, 3] = offset
+        return ColorPipeline([("matrix", affine)])
+
+    @staticmethod
+    def lut(table):
+        """
+        :param table: a 256 entry table used for every channel or a 3x256
+            table with one row per channel
+        """
+        table = np.asarray(table, dtype=np.uint8)
+        if table.ndim == 1:
+            table = np.stack([table] * 3)
+        return ColorPipeline([("lut", table)])
+
+    @staticmethod
+    def saturation(factor):
+        """
+        The same adjustment as ImageEnhance.Color(image).enhance(factor),
+        a blend between the grayscale image and the image.
+        """
+        return ColorPipeline.matrix(factor * np.eye(3) + (1 - factor) * np.outer(np.ones(3), LUMA))
+
+    @staticmethod
+    def invert():
+        return ColorPipeline.matrix(-np.eye(3), (255, 255, 255))
+
+    def then(self, other):
+        """
+        Return a pipeline running this pipeline and then other.
+        """
+        return ColorPipeline(self.stages + other.stages)
+
+    def apply(self, image):
+        """
+        Return a copy of an image with the pipeline applied to its color
+        channels, the image is returned as RGBA and keeps its alpha.
+        """
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if not self.stages:
+            return image.copy()
+        result = image
+        # tables run on RGBA directly, PIL only converts RGB with a matrix so
+        # the alpha is set aside for matrix stages
+        for kind, value in self.stages:
+            if kind == "lut":
+                table = value.ravel().tolist()
+                result = result.point(table + ALPHA_IDENTITY if result.mode == "RGBA" else table)
+            else:
+                result = result.convert("RGB").convert("RGB", tuple(value.ravel().tolist()))
+        if result.mode != "RGBA":
+            result.putalpha(image.getchannel("A"))
+        return result
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+# default budget of the shared cache in bytes
+MAX_BYTES = 256 * 1024 * 1024
+
+
+def filter_key(image_filter):
+    """
+    Return a hashable (class, parameters) key describing what a filter
+    does, or None when its parameters cannot be hashed.
+    """
+    if image_filter is None:
+        return None
+    params = tuple(sorted(vars(image_filter).items()))
+    try:
+        hash(params)
+    except TypeError:
+        return None
+    return type(image_filter), params
+
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class FilterCache:
+    """
+    Bounded LRU cache of filtered images.
+
+    Keys are built by the caller and should contain the version of the
+    source image and the filter_key of the filter. Image versions are unique
+    within a process, loaded images get new ones, so a version never refers
+    to two different images. The least recently used images are dropped
+    once the images take more than max_bytes. The cache is shared by the GUI
+    and the worker threads.
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, image):
+        size = image_bytes(image)
+        # an image taking most of the budget would flush everything else
+        if size > self.max_bytes // 2:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (image, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _key, (_image, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+# shared by filter previews and filter jobs
+filter_cache = FilterCache()
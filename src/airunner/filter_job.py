@@ -0,0 +1,96 @@
+import threading
+from PyQt6 import QtCore
+from tiled_filter import apply_tiled
+from filter_cache import filter_cache
+
+
+class FilterCancelled(Exception):
+    pass
+
+
+class FilterJob(QtCore.QObject):
+    """
+    Applies a filter to a list of images on a worker thread.
+
+    progress is emitted with a percentage, finished with the list of
+    results (in the order of the sources) and cancelled when cancel() was
+    called before the job finished. Nothing is emitted after cancelled.
+    """
+    progress = QtCore.pyqtSignal(int)
+    finished = QtCore.pyqtSignal(object)
+    cancelled = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, sources, image_filter, output=None, keys=None, parent=None):
+        """
+        :param sources: callables returning the PIL images to filter, they
+            are called on the worker thread
+        :param image_filter: the PIL filter to apply
+        :param output: optional callable turning (index, filtered image) into
+            the result, also called on the worker thread
+        :param keys: optional filter cache keys of the filtered images, a
+            cached image is used instead of filtering again
+        """
+        super().__init__(parent)
+        self.sources = sources
+        self.image_filter = image_filter
+        self.output = output
+        self.keys = keys or [None] * len(sources)
+        self.cancel_event = threading.Event()
+        self.thread = None
+
+    @property
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="filter job", daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.is_cancelled:
+            raise FilterCancelled()
+
+    def report(self, done, total):
+        self.progress.emit(int(done * 100 / max(1, total)))
+
+    def filter_image(self, image, step, steps):
+        """
+        Filter a single image in parallel blocks, step and steps place it
+        in the overall progress of the job.
+        """
+        image = apply_tiled(
+            image,
+            self.image_filter,
+            progress=lambda done, total: self.report(step + done / total, steps),
+            is_cancelled=lambda: self.is_cancelled
+        )
+        self.check_cancelled()
+        return image
+
+    def run(self):
+        results = []
+        steps = len(self.sources)
+        try:
+            for step, source in enumerate(self.sources):
+                self.check_cancelled()
+                key = self.keys[step]
+                image = filter_cache.get(key) if key is not None else None
+                if image is None:
+                    image = self.filter_image(source(), step, steps)
+                    self.check_cancelled()
+                    if key is not None:
+                        filter_cache.put(key, image)
+                results.append(self.output(step, image) if self.output else image)
+                self.report(step + 1, steps)
+            self.check_cancelled()
+        except FilterCancelled:
+            self.cancelled.emit()
+            return
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.finished.emit(results)
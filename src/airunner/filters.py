@@ -1,12 +1,47 @@
+import hashlib
+import logging
 import os
+import threading
+from collections import OrderedDict
 
-from PIL import ImageEnhance, Image, ImageFilter
-from PIL.ImageFilter import GaussianBlur, BoxBlur, UnsharpMask, Filter
+import numpy as np
+from PIL import Image, ImageFilter
+from PIL.ImageFilter import GaussianBlur, BoxBlur, UnsharpMask
 from PyQt6 import uic
+from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import QProgressDialog
 from aihandler.qtvar import FloatVar, IntVar
+from color_ops import ColorPipeline
+import palette
 
 
-class ColorBalanceFilter(Filter):
+class ImageFunctionFilter:
+    """
+    Base class of filters implemented on PIL images by apply_image(), they
+    are run with tiled_filter.run_filter rather than Image.filter.
+    """
+    def apply_image(self, image):
+        return image
+
+
+class ColorFilter(ImageFunctionFilter):
+    """
+    Base class of filters which adjust every pixel on its own. The
+    adjustment is described by a ColorPipeline so several of them run as a
+    single pass and alpha is kept.
+    """
+    # each pixel only depends on itself
+    halo = 0
+
+    @property
+    def pipeline(self):
+        return ColorPipeline()
+
+    def apply_image(self, image):
+        return self.pipeline.apply(image)
+
+
+class ColorBalanceFilter(ColorFilter):
     name = "Color Balance"
 
     def __init__(self, cyan_red=0, magenta_green=0, yellow_blue=0):
@@ -14,23 +49,103 @@ class ColorBalanceFilter(Filter):
         self.magenta_green = magenta_green
         self.yellow_blue = yellow_blue
 
-    def filter(self, image):
-        # Apply enhancement
-        image = ImageEnhance.Color(image).enhance(1.0 + self.cyan_red)
-        image = ImageEnhance.Color(image).enhance(1.0 + self.magenta_green)
-        image = ImageEnhance.Color(image).enhance(1.0 + self.yellow_blue)
-        return image
+    @property
+    def pipeline(self):
+        # the three enhancements are multiplied into one color matrix
+        return ColorPipeline.saturation(1.0 + self.cyan_red).then(
+            ColorPipeline.saturation(1.0 + self.magenta_green)
+        ).then(
+            ColorPipeline.saturation(1.0 + self.yellow_blue)
+        )
 
 
-class SaturationFilter(Filter):
+class SaturationFilter(ColorFilter):
     name = "Saturation"
 
     def __init__(self, factor=1.0):
         self.factor = factor
 
-    def filter(self, image):
-        print(image)
-        return ImageEnhance.Color(image).enhance(1.0 + self.factor)
+    @property
+    def pipeline(self):
+        return ColorPipeline.saturation(1.0 + self.factor)
+
+
+class GrainFilter(ImageFunctionFilter):
+    """
+    Monochrome film grain. The noise is a seeded texture which repeats
+    every texture_size pixels, textures are cached per grain size and seed
+    so changing the amount only blends again.
+    """
+    name = "Grain"
+    # the grain is anchored to the top left of the image
+    whole_image = True
+    texture_size = 512
+    # standard deviation of the noise at amount 1.0
+    strength = 64
+    # shared by the preview and filter job threads
+    textures = OrderedDict()
+    textures_lock = threading.Lock()
+    max_textures = 8
+
+    def __init__(self, amount=0.25, size=1, seed=0):
+        """
+        :param amount: 0.0 to 1.0
+        :param size: grain size in pixels
+        """
+        self.amount = amount
+        self.size = max(1, int(size))
+        self.seed = seed
+
+    def texture(self):
+        """
+        Return the zero mean, unit variance float32 noise texture for the
+        grain size and seed.
+        """
+        key = (self.size, self.seed)
+        with GrainFilter.textures_lock:
+            cached = GrainFilter.textures.get(key)
+            if cached is not None:
+                GrainFilter.textures.move_to_end(key)
+                return cached
+        cells = max(1, -(-self.texture_size // self.size))
+        noise = np.random.default_rng(self.seed).standard_normal((cells, cells)).astype(np.float32)
+        if self.size > 1:
+            # wrap a cell around the edges before smoothing so the texture tiles without seams
+            padded = np.pad(noise, 1, mode="wrap")
+            side = (cells + 2) * self.size
+            smooth = np.asarray(Image.fromarray(padded, "F").resize((side, side), Image.BICUBIC))
+            noise = smooth[self.size:-self.size, self.size:-self.size]
+        noise = (noise - noise.mean()) / max(float(noise.std()), 1e-6)
+        with GrainFilter.textures_lock:
+            GrainFilter.textures[key] = noise
+            if len(GrainFilter.textures) > GrainFilter.max_textures:
+                GrainFilter.textures.popitem(last=False)
+        return noise
+
+    def scaled(self, scale):
+        """
+        Return the grain as it looks on the image scaled by scale. Grain
+        smaller than a pixel averages out, which lowers its amount.
+        """
+        size = self.size * scale
+        return GrainFilter(self.amount * min(1.0, size), max(1, round(size)), self.seed)
+
+    def apply_image(self, image):
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if self.amount <= 0:
+            return image.copy()
+        # scale the small texture first, the image is only touched by the blend
+        offsets = np.rint(self.texture() * (self.amount * self.strength)).astype(np.int16)
+        width, height = image.size
+        offsets = np.tile(
+            offsets, (-(-height // offsets.shape[0]), -(-width // offsets.shape[1]))
+        )[:height, :width, None]
+        pixels = np.asarray(image)
+        result = np.empty_like(pixels)
+        result[..., :3] = np.clip(pixels[..., :3] + offsets, 0, 255)
+        result[..., 3] = pixels[..., 3]
+        return Image.fromarray(result, "RGBA")
 
 
 class FilterBase:
@@ -44,6 +159,16 @@ class FilterBase:
     def update_canvas(self):
         self.canvas.update()
 
+    def update_filter(self):
+        """
+        Preview the filter with the current values. The filter is built once
+        per frame, values set by sliders in between are dropped.
+        """
+        self.canvas.repaint_scheduler.defer("filter", self.set_current_filter)
+
+    def set_current_filter(self):
+        self.parent.current_filter = self.filter
+
     def __init__(self, parent):
         self.filter_window = None
         self.parent = parent
@@ -56,12 +181,52 @@ class FilterBase:
 
     def cancel_filter(self):
         self.filter_window.close()
+        self.canvas.repaint_scheduler.discard("filter")
         self.parent.current_filter = None
+        self.canvas.filter_preview.clear()
         self.update_canvas()
 
     def apply_filter(self):
-        self.canvas.apply_filter()
+        # apply the latest values even if their preview has not been painted yet
+        self.canvas.repaint_scheduler.discard("filter")
+        self.set_current_filter()
         self.filter_window.close()
+        if self.parent.filters_as_adjustments:
+            self.canvas.add_adjustment()
+            self.stop_preview()
+            return
+        job = self.canvas.apply_filter()
+        if job is None:
+            self.stop_preview()
+            return
+
+        # the preview stays on screen while the full resolution pass runs
+        progress_dialog = QProgressDialog("Applying filter...", "Cancel", 0, 100, self.parent.window)
+        progress_dialog.setWindowTitle(self.window_title)
+        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        progress_dialog.setMinimumDuration(250)
+        progress_dialog.setAutoClose(False)
+        progress_dialog.setValue(0)
+        progress_dialog.canceled.connect(job.cancel)
+        job.progress.connect(progress_dialog.setValue)
+
+        def done(*args):
+            progress_dialog.close()
+            self.stop_preview()
+
+        def failed(message):
+            done()
+            message = f"{self.window_title or 'Filter'} failed: {message}"
+            logging.getLogger().error(message)
+            self.parent.error_handler(message)
+
+        job.finished.connect(done)
+        job.cancelled.connect(done)
+        job.failed.connect(failed)
+
+    def stop_preview(self):
+        self.parent.current_filter = None
+        self.canvas.filter_preview.clear()
         self.update_canvas()
 
 
@@ -100,14 +265,12 @@ class BlurFilter(FilterBase):
     def handle_blur_radius_slider_change(self, val):
         self.blur_radius.set(float(val))
         self.filter_window.blur_spinbox.setValue(float(val))
-        self.parent.current_filter = self.filter
-        self.canvas.update()
+        self.update_filter()
 
     def handle_blur_radius_spinbox_change(self, val):
         self.blur_radius.set(val)
         self.filter_window.blur_slider.setValue(int(val))
-        self.parent.current_filter = self.filter
-        self.update_canvas()
+        self.update_filter()
 
 
 class FilterGaussianBlur(BlurFilter):
@@ -169,9 +332,8 @@ class FilterPixelArt(FilterBase):
         self.filter_window.buttonBox.rejected.connect(self.cancel_filter)
         self.filter_window.buttonBox.accepted.connect(self.apply_filter)
 
-        # apply the filter
+        # preview the filter, it is only applied at full resolution on ok
         self.parent.current_filter = self.filter
-        self.canvas.apply_filter()
         self.update_canvas()
 
         self.filter_window.exec()
@@ -186,8 +348,7 @@ class FilterPixelArt(FilterBase):
 
     def handle_number_of_colors_change(self, val):
         self.number_of_colors = val
-        self.parent.current_filter = self.filter
-        self.canvas.update()
+        self.update_filter()
 
     def handle_base_size_change_slider(self, val):
         val = val - (val % 16)
@@ -201,35 +362,71 @@ class FilterPixelArt(FilterBase):
 
     def handle_base_size_change(self, val):
         self.base_size = val
-        self.parent.current_filter = self.filter
-        self.canvas.update()
+        self.update_filter()
 
 
-class PixelFilter(ImageFilter.Filter):
+class PixelFilter(ImageFunctionFilter):
     name = "Resize Filter"
-
-    def __init__(self, number_of_colors=24, smoothing=1, base_size=16):
+    # the pixel size depends on the size of the whole image
+    whole_image = True
+    # palettes of recently filtered images keyed by their downsized pixels,
+    # shared by the preview and filter job threads
+    palettes = OrderedDict()
+    palettes_lock = threading.Lock()
+    max_palettes = 32
+
+    def __init__(self, number_of_colors=24, smoothing=1, base_size=16, method="mediancut"):
+        """
+        :param method: "mediancut" or "kmeans", how the palette is built
+        """
         self.number_of_colors = number_of_colors
         self.smoothing = smoothing
         self.base_size = base_size
+        self.method = method
+
+    def build_palette(self, pixels):
+        """
+        Return the palette for (n, 3) pixels. The palette only changes when
+        the downsized source changes, so it is cached on a digest of the
+        pixels rather than computed on every slider move.
+        """
+        key = (hashlib.sha1(pixels.tobytes()).digest(), self.number_of_colors, self.method)
+        with PixelFilter.palettes_lock:
+            cached = PixelFilter.palettes.get(key)
+            if cached is not None:
+                PixelFilter.palettes.move_to_end(key)
+                return cached
+        if self.method == "kmeans":
+            colors = palette.kmeans(pixels, self.number_of_colors)
+        else:
+            colors = palette.median_cut(pixels, self.number_of_colors)
+        with PixelFilter.palettes_lock:
+            PixelFilter.palettes[key] = colors
+            if len(PixelFilter.palettes) > PixelFilter.max_palettes:
+                PixelFilter.palettes.popitem(last=False)
+        return colors
+
+    def apply_image(self, image):
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
 
-    def filter(self, image):
         # Downsize while maintaining aspect ratio
         width, height = image.size
         scale = min(self.base_size / width, self.base_size / height)
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        downsized = image.resize((new_width, new_height), Image.NEAREST)
+        new_width = max(1, int(width * scale))
+        new_height = max(1, int(height * scale))
+        downsized = np.array(image.resize((new_width, new_height), Image.NEAREST))
+
+        # Reduce the number of colors at the downsized size, transparent
+        # pixels do not take up palette entries
+        opaque = downsized[..., 3] > 0
+        pixels = downsized[..., :3][opaque]
+        if len(pixels):
+            colors = self.build_palette(pixels)
+            downsized[..., :3][opaque] = colors[palette.nearest(pixels, colors)]
 
         # Upscale back to original dimensions
-        target_width = int(new_width / scale)
-        target_height = int(new_height / scale)
-        upscaled = downsized.resize((target_width, target_height), Image.NEAREST)
-
-        # Reduce number of colors
-        quantized = upscaled.quantize(self.number_of_colors)
-        quantized = quantized.convert("L")
-        return quantized
+        return Image.fromarray(downsized, "RGBA").resize((width, height), Image.NEAREST)
 
 
 class FilterUnsharpMask(FilterBase):
@@ -254,51 +451,47 @@ class FilterUnsharpMask(FilterBase):
         self.unsharp_percent = 0.5
         self.unsharp_threshold = 0.5
 
-        def update_filter():
-            self.parent.current_filter = self.filter
-            self.canvas.update()
-
         def handle_unsharp_radius_slider_change(val):
             self.unsharp_radius = val
             self.filter_window.radius_spinbox.setValue(val)
             self.filter_window.radius_spinbox.update()
             self.filter_window.radius_slider.update()
-            update_filter()
+            self.update_filter()
 
         def handle_unsharp_radius_spinbox_change(val):
             self.unsharp_radius = val
             self.filter_window.radius_slider.setValue(int(val))
             self.filter_window.radius_spinbox.update()
             self.filter_window.radius_slider.update()
-            update_filter()
+            self.update_filter()
 
         def handle_unsharp_percent_slider_change(val):
             self.unsharp_percent = val
             self.filter_window.percent_spinbox.setValue(val)
             self.filter_window.percent_spinbox.update()
             self.filter_window.percent_slider.update()
-            update_filter()
+            self.update_filter()
 
         def handle_unsharp_percent_spinbox_change(val):
             self.unsharp_percent = val
             self.filter_window.percent_slider.setValue(int(val))
             self.filter_window.percent_spinbox.update()
             self.filter_window.percent_slider.update()
-            update_filter()
+            self.update_filter()
 
         def handle_unsharp_threshold_slider_change(val):
             self.unsharp_threshold = val
             self.filter_window.threshold_spinbox.setValue(val)
             self.filter_window.threshold_spinbox.update()
             self.filter_window.threshold_slider.update()
-            update_filter()
+            self.update_filter()
 
         def handle_unsharp_threshold_spinbox_change(val):
             self.unsharp_threshold = val
             self.filter_window.threshold_slider.setValue(int(val))
             self.filter_window.threshold_spinbox.update()
             self.filter_window.threshold_slider.update()
-            update_filter()
+            self.update_filter()
 
         # set the gaussian_blur_window settings values to the current settings
         self.filter_window.radius_slider.setValue(int(self.unsharp_radius))
@@ -354,14 +547,12 @@ class FilterSaturation(FilterBase):
         print(val)
         self.factor = float(val)
         self.filter_window.blur_spinbox.setValue(val / 1000.0)
-        self.parent.current_filter = self.filter
-        self.canvas.update()
+        self.update_filter()
 
     def handle_blur_radius_spinbox_change(self, val):
         self.factor = val / 100.0
         self.filter_window.blur_slider.setValue(int(val * 1000.0))
-        self.parent.current_filter = self.filter
-        self.update_canvas()
+        self.update_filter()
 
 
 class FilterColorBalance(FilterBase):
@@ -389,39 +580,35 @@ class FilterColorBalance(FilterBase):
         self.magenta_green.set(0)
         self.yellow_blue.set(0)
 
-        def update_filter():
-            self.parent.current_filter = self.filter
-            self.canvas.update()
-
         def color_balance_cyan_slider_change(val):
             self.filter_window.cyan_spinbox.setValue(val / 1000.0)
             self.filter_window.cyan_spinbox.update()
-            update_filter()
+            self.update_filter()
 
         def color_balance_magenta_slider_change(val):
             self.filter_window.magenta_spinbox.setValue(val / 1000.0)
             self.filter_window.magenta_spinbox.update()
-            update_filter()
+            self.update_filter()
 
         def color_balance_yellow_slider_change(val):
             self.filter_window.yellow_spinbox.setValue(val / 1000.0)
             self.filter_window.yellow_spinbox.update()
-            update_filter()
+            self.update_filter()
 
         def color_balance_cyan_spinbox_change(val):
             self.filter_window.cyan_slider.setValue(int(val * 1000.0))
             self.filter_window.cyan_slider.update()
-            update_filter()
+            self.update_filter()
 
         def color_balance_magenta_spinbox_change(val):
             self.filter_window.magenta_slider.setValue(int(val * 1000.0))
             self.filter_window.magenta_slider.update()
-            update_filter()
+            self.update_filter()
 
         def color_balance_yellow_spinbox_change(val):
             self.filter_window.yellow_slider.setValue(int(val * 1000.0))
             self.filter_window.yellow_slider.update()
-            update_filter()
+            self.update_filter()
 
         self.filter_window.cyan_slider.setValue(self.cyan_red.get())
         self.filter_window.cyan_slider.valueChanged.connect(lambda val: color_balance_cyan_slider_change(val))
@@ -443,3 +630,57 @@ class FilterColorBalance(FilterBase):
         self.filter_window.buttonBox.accepted.connect(self.apply_filter)
 
         self.filter_window.exec()
+
+
+class FilterGrain(FilterBase):
+    ui_name = "grain"
+    window_title = "Grain"
+    amount = 25
+    size = 1
+    seed = 0
+
+    @property
+    def filter(self):
+        return GrainFilter(amount=self.amount / 100, size=self.size, seed=self.seed)
+
+    def show(self):
+        super().show()
+
+        for slider, spinbox, value in (
+            (self.filter_window.amount_slider, self.filter_window.amount_spinbox, self.amount),
+            (self.filter_window.size_slider, self.filter_window.size_spinbox, self.size),
+        ):
+            spinbox.setMaximum(slider.maximum())
+            slider.setValue(value)
+            spinbox.setValue(value)
+        self.filter_window.size_slider.setMinimum(1)
+        self.filter_window.size_spinbox.setMinimum(1)
+
+        self.filter_window.amount_slider.valueChanged.connect(
+            lambda val: self.handle_amount_change(val, self.filter_window.amount_spinbox))
+        self.filter_window.amount_spinbox.valueChanged.connect(
+            lambda val: self.handle_amount_change(val, self.filter_window.amount_slider))
+        self.filter_window.size_slider.valueChanged.connect(
+            lambda val: self.handle_size_change(val, self.filter_window.size_spinbox))
+        self.filter_window.size_spinbox.valueChanged.connect(
+            lambda val: self.handle_size_change(val, self.filter_window.size_slider))
+
+        # on ok button click, apply the filter
+        self.filter_window.buttonBox.rejected.connect(self.cancel_filter)
+        self.filter_window.buttonBox.accepted.connect(self.apply_filter)
+
+        self.parent.current_filter = self.filter
+        self.update_canvas()
+
+        self.filter_window.exec()
+
+    def handle_amount_change(self, val, other):
+        # the noise texture is cached, a new amount only blends again
+        self.amount = val
+        other.setValue(val)
+        self.update_filter()
+
+    def handle_size_change(self, val, other):
+        self.size = val
+        other.setValue(val)
+        self.update_filter()
@@ -0,0 +1,344 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from masks import alpha_mask
+from strokes import rasterize
+
+# number of areas whose prepared input is kept
+MAX_PREPARED = 4
+
+# size of the cells dirty regions are rounded to
+DIRTY_CELL = 64
+
+# the working image is filled with this where the crop does not reach
+FILL = (0, 0, 0, 255)
+
+
+class PreparedInput:
+    """
+    A prepared image and mask together with what they were made from.
+    """
+    def __init__(self, rect, has_image, tile_versions, lines_version, rows, image, mask):
+        self.rect = rect
+        self.has_image = has_image
+        self.tile_versions = tile_versions
+        self.lines_version = lines_version
+        self.rows = rows
+        self.image = image
+        self.mask = mask
+        self.result = {
+            "mask": mask,
+            "image": image.convert("RGB"),
+        }
+
+
+_prepared = OrderedDict()
+_prepared_lock = threading.Lock()
+
+
+def stroke_rows(lines):
+    """
+    Return the segments of a StrokeStore as (x0, y0, x1, y1, rgba, width)
+    rows, which compare equal between stores with different pen tables.
+    """
+    pens = np.array([pen[:2] for pen in lines.pens], dtype=np.int64).reshape(-1, 2)
+    return np.hstack((lines.segments.astype(np.int64), pens[lines.pen_ids]))
+
+
+def _row_view(rows):
+    view = np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))
+    return np.ascontiguousarray(rows).view(view).ravel()
+
+
+def _numbered(rows):
+    """
+    Return the rows with a column counting earlier copies of the same row,
+    which makes every row unique.
+    """
+    _, inverse = np.unique(_row_view(rows), return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind="stable")
+    grouped = inverse[order]
+    starts = np.flatnonzero(np.concatenate(([True], grouped[1:] != grouped[:-1])))
+    lengths = np.diff(np.concatenate((starts, [len(rows)])))
+    copies = np.empty(len(rows), dtype=np.int64)
+    copies[order] = np.arange(len(rows)) - np.repeat(starts, lengths)
+    return np.hstack((rows, copies[:, None]))
+
+
+def changed_rows(rows, other):
+    """
+    Return the rows of rows which are not in other and the rows of other
+    which are not in rows, counting repeated rows. Returns None when the
+    rows in both are not drawn in the same order, later rows are drawn over
+    earlier ones so that can change pixels anywhere they overlap.
+    """
+    if len(rows) == 0 or len(other) == 0:
+        return rows, other
+    numbered, other_numbered = _numbered(rows), _numbered(other)
+    view, other_view = _row_view(numbered), _row_view(other_numbered)
+    present = np.isin(view, other_view)
+    other_present = np.isin(other_view, view)
+    if not np.array_equal(view[present], other_view[other_present]):
+        return None
+    return rows[~present], other[~other_present]
+
+
+class GenerateInput:
+    """
+    What a generate request reads from the current layer, taken on the GUI
+    thread so the image and mask can be prepared on the request thread.
+
+    The image shares its tiles with the layer copy-on-write and the strokes
+    are copied, so edits made while the request waits do not reach the
+    snapshot and taking it does not copy any pixels.
+
+    Prepared inputs are cached by layer, crop and working size. Preparing
+    the same area again returns the cached image and mask when neither the
+    tiles nor the strokes changed, otherwise only the cells touched by
+    changed tiles or strokes are rendered again.
+
+    The adjustments of the layer are applied to the tiles under the crop
+    when the input is prepared, the generator sees the layer as it is drawn.
+    """
+    def __init__(self, layer, crop_location, working_size, mask_dilation=0, mask_feather=0):
+        self.layer_id = layer.uuid
+        self.layer_image = layer.images[0] if layer.images else None
+        self.image = self.layer_image.copy() if self.layer_image is not None else None
+        self.adjustments = layer.adjustments
+        self.nodes = layer.adjustments.nodes
+        self.flattened = False
+        self.lines_version = layer.lines.version
+        self.lines = layer.lines.copy()
+        self.crop_location = tuple(crop_location)
+        self.working_size = working_size
+        self.mask_dilation = mask_dilation
+        self.mask_feather = mask_feather
+
+    @property
+    def key(self):
+        return (
+            self.layer_id, self.crop_location, self.working_size, self.mask_dilation, self.mask_feather,
+            tuple(node.version for node in self.nodes)
+        )
+
+    @property
+    def rect(self):
+        """
+        The canvas box of the image the strokes are drawn on.
+        """
+        if self.image is not None:
+            return self.image.rect
+        return (0, 0) + self.working_size
+
+    def crop_box(self):
+        """
+        The canvas box of the image pixels under the crop.
+        """
+        left, top, right, bottom = self.rect
+        x, y = self.crop_location[:2]
+        return (
+            max(left, left + x),
+            max(top, top + y),
+            min(right, left + x + self.working_size[0]),
+            min(bottom, top + y + self.working_size[1])
+        )
+
+    def tile_versions(self):
+        """
+        Return {key: version} of the tiles under the crop.
+        """
+        if self.image is None:
+            return {}
+        tiles = self.image.tiles
+        return {key: tiles.tile_version(key) for key in tiles.keys_in_box(self.crop_box())}
+
+    def apply_adjustments(self):
+        """
+        Replace the image with its tiles under the crop after the
+        adjustments, the tiles keep the version of the adjustment output.
+        """
+        if self.flattened or self.image is None or not self.nodes:
+            return
+        self.flattened = True
+        # the filtered tiles are cached per layer image, they can be shared
+        # with the canvas unless the image was moved or resized since
+        image = self.layer_image if self.layer_image.rect == self.image.rect else self.image
+        self.image = self.adjustments.flatten(image, self.crop_box(), self.nodes, self.image.tiles)
+
+    def prepare(self):
+        """
+        Return the "image" and "mask" options of the request, the image with
+        the strokes burned in cropped to the active grid area as RGB and the
+        mask of its empty pixels. The returned images are shared with the
+        cache and must not be modified.
+        """
+        with _prepared_lock:
+            prepared = _prepared.get(self.key)
+            if prepared is not None:
+                _prepared.move_to_end(self.key)
+
+        self.apply_adjustments()
+        rect = self.rect
+        tile_versions = self.tile_versions()
+        has_image = self.image is not None
+        if prepared is not None and (prepared.rect, prepared.has_image) != (rect, has_image):
+            prepared = None
+        if prepared is not None and prepared.tile_versions == tile_versions \
+                and prepared.lines_version == self.lines_version:
+            return prepared.result
+
+        rows = stroke_rows(self.lines)
+        width, height = self.working_size
+        boxes = None
+        if prepared is not None:
+            boxes = self.dirty_boxes(prepared, tile_versions, rows)
+            # rendering most of the image in pieces is slower than rendering it at once
+            if boxes is not None and sum((box[2] - box[0]) * (box[3] - box[1]) for box in boxes) > width * height // 2:
+                boxes = None
+        if boxes is None:
+            image = self.render_box((0, 0, width, height))
+            mask = alpha_mask(image, dilation=self.mask_dilation, feather=self.mask_feather)
+        else:
+            image = prepared.image.copy()
+            mask = prepared.mask.copy()
+            for box in boxes:
+                image.paste(self.render_box(box), box[:2])
+            # the mask of a box reads the pixels around it, so all boxes are rendered first
+            for box in boxes:
+                self.update_mask(mask, image, box)
+
+        prepared = PreparedInput(rect, has_image, tile_versions, self.lines_version, rows, image, mask)
+        with _prepared_lock:
+            _prepared[self.key] = prepared
+            while len(_prepared) > MAX_PREPARED:
+                _prepared.popitem(last=False)
+        return prepared.result
+
+    def render_box(self, box):
+        """
+        Return the pixels of the working image inside a (left, top, right,
+        bottom) box of working image coordinates.
+        """
+        left, top, right, bottom = box
+        crop_left, crop_top, crop_right, crop_bottom = self.crop_location
+        region = Image.new("RGBA", (right - left, bottom - top), FILL)
+        # the working image shows the crop from its top left corner
+        right = min(right, crop_right - crop_left)
+        bottom = min(bottom, crop_bottom - crop_top)
+        if right <= left or bottom <= top:
+            return region
+        source = (left + crop_left, top + crop_top, right + crop_left, bottom + crop_top)
+        region.paste(self.render_source(source), (0, 0))
+        return region
+
+    def render_source(self, box):
+        """
+        Return the image with the strokes burned in inside a box of image
+        coordinates (relative to the top left of the image), transparent
+        outside of the image.
+        """
+        left, top, right, bottom = box
+        image_left, image_top, image_right, image_bottom = self.rect
+        width, height = image_right - image_left, image_bottom - image_top
+        region = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        indices = []
+        outer = box
+        if len(self.lines):
+            boxes = self.lines.boxes()
+            indices = np.flatnonzero(
+                (boxes[:, 0] < right) & (boxes[:, 2] > left) & (boxes[:, 1] < bottom) & (boxes[:, 3] > top)
+            )
+            if len(indices):
+                # cv2 rounds lines it clips differently, so the strokes are drawn
+                # whole and only clipped by the edges of the image as before
+                boxes = boxes[indices]
+                outer = (
+                    min(left, int(boxes[:, 0].min())),
+                    min(top, int(boxes[:, 1].min())),
+                    max(right, int(boxes[:, 2].max())),
+                    max(bottom, int(boxes[:, 3].max()))
+                )
+        outer = (max(0, outer[0]), max(0, outer[1]), min(width, outer[2]), min(height, outer[3]))
+        if outer[2] <= outer[0] or outer[3] <= outer[1]:
+            return region
+        if self.image is not None:
+            pixels = self.image.crop((
+                outer[0] + image_left, outer[1] + image_top, outer[2] + image_left, outer[3] + image_top
+            ))
+        else:
+            pixels = Image.new("RGBA", (outer[2] - outer[0], outer[3] - outer[1]), (0, 0, 0, 0))
+        if len(indices):
+            pixels = Image.fromarray(rasterize(self.lines, np.array(pixels), indices, (-outer[0], -outer[1])))
+        region.paste(pixels, (outer[0] - left, outer[1] - top))
+        return region
+
+    def dirty_boxes(self, prepared, tile_versions, rows):
+        """
+        Return the boxes of the working image which changed since prepared,
+        as rows of DIRTY_CELL cells, or None when everything has to be
+        rendered again.
+        """
+        width, height = self.working_size
+        crop_left, crop_top = self.crop_location[:2]
+        image_left, image_top = self.rect[:2]
+        boxes = []
+        if self.image is not None:
+            keys = [key for key, version in tile_versions.items() if prepared.tile_versions.get(key) != version]
+            # tiles the previous input was made from which are gone changed as well
+            keys += [key for key in prepared.tile_versions if key not in tile_versions]
+            for key in keys:
+                left, top, right, bottom = self.image.tiles.tile_rect(key)
+                boxes.append((left - image_left, top - image_top, right - image_left, bottom - image_top))
+        if prepared.lines_version != self.lines_version:
+            changed = changed_rows(rows, prepared.rows)
+            if changed is None:
+                return None
+            for x0, y0, x1, y1, _rgba, pen_width in np.vstack(changed).tolist():
+                pad = pen_width // 2 + 2
+                boxes.append((min(x0, x1) - pad, min(y0, y1) - pad, max(x0, x1) + pad + 1, max(y0, y1) + pad + 1))
+
+        columns = -(-width // DIRTY_CELL)
+        cells = np.zeros((-(-height // DIRTY_CELL), columns), dtype=bool)
+        for left, top, right, bottom in boxes:
+            left, right = max(0, left - crop_left), min(width, right - crop_left)
+            top, bottom = max(0, top - crop_top), min(height, bottom - crop_top)
+            if right > left and bottom > top:
+                cells[top // DIRTY_CELL:-(-bottom // DIRTY_CELL), left // DIRTY_CELL:-(-right // DIRTY_CELL)] = True
+
+        # merge the dirty cells of every row into runs
+        dirty = []
+        for row in np.flatnonzero(cells.any(axis=1)):
+            line = np.concatenate(([False], cells[row], [False]))
+            edges = np.flatnonzero(line[1:] != line[:-1])
+            for first, last in zip(edges[0::2], edges[1::2]):
+                dirty.append((
+                    int(first) * DIRTY_CELL,
+                    int(row) * DIRTY_CELL,
+                    min(width, int(last) * DIRTY_CELL),
+                    min(height, (int(row) + 1) * DIRTY_CELL)
+                ))
+        return dirty
+
+    def update_mask(self, mask, image, box):
+        """
+        Recompute the mask where pixels changed inside box, dilation and
+        feathering spread a change over margin pixels around it.
+        """
+        margin = self.mask_dilation + self.mask_feather + 1
+        affected = self.grow(box, margin, image.size)
+        outer = self.grow(affected, margin, image.size)
+        region = alpha_mask(image.crop(outer), dilation=self.mask_dilation, feather=self.mask_feather)
+        mask.paste(region.crop((
+            affected[0] - outer[0], affected[1] - outer[1], affected[2] - outer[0], affected[3] - outer[1]
+        )), affected[:2])
+
+    @staticmethod
+    def grow(box, margin, size):
+        return (
+            max(0, box[0] - margin),
+            max(0, box[1] - margin),
+            min(size[0], box[2] + margin),
+            min(size[1], box[3] + margin)
+        )
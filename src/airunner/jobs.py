@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import queue
+import threading
+
+# priorities, lower values run first
+INTERACTIVE = 0
+BATCH = 10
+
+_job_ids = itertools.count(1)
+
+
+def request_key(data):
+    """
+    Return a key which is equal for requests that would produce the same
+    kind of result, or None for messages that are not requests. The seed
+    and the input snapshot are left out, a newer click means the same
+    request with more recent input. Requests with a random seed should not
+    supersede each other, each of them asks for another image.
+    """
+    if not isinstance(data, dict) or "options" not in data:
+        return None
+    action = data.get("action")
+    skip = ("prepare", f"{action}_seed")
+    return action, tuple(sorted(
+        (key, repr(value)) for key, value in data["options"].items() if key not in skip
+    ))
+
+
+class Job:
+    def __init__(self, data, priority=INTERACTIVE, key=None):
+        self.id = next(_job_ids)
+        self.data = data
+        self.priority = priority
+        self.key = key
+        self.cancelled = False
+        # place in line, set when the job is first queued
+        self.order = None
+
+
+class JobQueue:
+    """
+    Pending generate requests ordered by priority, then by submission.
+
+    A job put while a job with the same key is pending supersedes it: the
+    old job is dropped and the new one takes its place in line. Queued jobs
+    can be cancelled by id. get() blocks like queue.Queue.get and
+    get_nowait() raises queue.Empty, so workers use it like a queue.
+
+    The job handed out by get() is the running job until finish() is
+    called, it is taken from the queue and made the running job under the
+    same lock so a job is always either queued or running.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.jobs = {}
+        self.keys = {}
+        self.sequence = itertools.count()
+        self.superseded = 0
+        self.cancelled = 0
+        self.running = None
+
+    def put(self, job):
+        """
+        Queue a Job, anything else (such as a stop sentinel) is handed to
+        the next get() before any job.
+        :return: the job which was superseded or None
+        """
+        with self.condition:
+            if not isinstance(job, Job):
+                heapq.heappush(self.heap, (-1, next(self.sequence), 0, job))
+                self.condition.notify()
+                return None
+            order = job.order if job.order is not None else next(self.sequence)
+            superseded = self.jobs.get(self.keys.get(job.key)) if job.key is not None else None
+            if superseded is not None:
+                # keep the place in line of the request being replaced
+                superseded.cancelled = True
+                self._forget(superseded)
+                self.superseded += 1
+                job.priority = min(job.priority, superseded.priority)
+                order = superseded.order
+            job.order = order
+            self.jobs[job.id] = job
+            if job.key is not None:
+                self.keys[job.key] = job.id
+            # a superseding job shares its order with the dropped one, job ids break the tie
+            heapq.heappush(self.heap, (job.priority, order, job.id, job))
+            self.condition.notify()
+            return superseded
+
+    def get(self):
+        with self.condition:
+            while True:
+                item = self._pop()
+                if item is not None:
+                    if isinstance(item, Job):
+                        self.running = item
+                    return item
+                self.condition.wait()
+
+    def finish(self, job):
+        with self.condition:
+            if self.running is job:
+                self.running = None
+
+    def get_nowait(self):
+        with self.condition:
+            item = self._pop()
+            if item is None:
+                raise queue.Empty
+            return item
+
+    def _pop(self):
+        # cancelled jobs stay in the heap until they come up
+        while self.heap:
+            item = heapq.heappop(self.heap)[-1]
+            if not isinstance(item, Job):
+                return item
+            if not item.cancelled:
+                self._forget(item)
+                return item
+        return None
+
+    def _forget(self, job):
+        self.jobs.pop(job.id, None)
+        if job.key is not None and self.keys.get(job.key) == job.id:
+            del self.keys[job.key]
+
+    def cancel(self, job_id):
+        """
+        Drop a queued job.
+        :return: True if the job was still queued
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            job.cancelled = True
+            self._forget(job)
+            self.cancelled += 1
+            return True
+
+    def clear(self):
+        """
+        Drop every queued job and return their ids.
+        """
+        with self.condition:
+            job_ids = list(self.jobs)
+            for job_id in job_ids:
+                self.cancel(job_id)
+            return job_ids
+
+    def depth(self, priority=None):
+        """
+        Number of queued jobs, of one priority when given.
+        """
+        with self.condition:
+            return sum(1 for job in self.jobs.values() if priority is None or job.priority == priority)
+
+    def pending(self):
+        """
+        Return (job id, priority) of the queued jobs in the order they run.
+        """
+        with self.condition:
+            return [
+                (job.id, job.priority)
+                for job in sorted(self.jobs.values(), key=lambda job: (job.priority, job.order))
+            ]
+
+    def empty(self):
+        return self.depth() == 0
@@ -2,7 +2,6 @@ import os
 import pickle
 import random
 import sys
-import cv2
 import numpy as np
 import torch
 from PIL.ImageFilter import Filter
@@ -15,9 +14,10 @@ from aihandler.qtvar import TQDMVar, ImageVar, MessageHandlerVar, ErrorHandlerVa
 from aihandler.settings import MAX_SEED, AVAILABLE_SCHEDULERS_BY_ACTION, MODELS, LOG_LEVEL
 from qtcanvas import Canvas
 from settingsmanager import SettingsManager
+from generate_input import GenerateInput
 from runai_client import OfflineClient
 from filters import FilterGaussianBlur, FilterBoxBlur, FilterUnsharpMask, FilterSaturation, \
-    FilterColorBalance, FilterPixelArt
+    FilterColorBalance, FilterPixelArt, FilterGrain
 import qdarktheme
 
 history_event_types = {
@@ -73,6 +73,13 @@ class MainWindow(QApplication):
             "controlnet",
         ]
     current_filter = None
+    # when set, applying a filter adds it as an adjustment of the layer
+    filters_as_adjustments = False
+    # pixels the inpaint mask grows into the image and the width of its soft edge
+    mask_dilation = 0
+    mask_feather = 0
+    # id of the last generate request, the interrupt button cancels it
+    last_job_id = None
     tabs = {}
     tqdm_callback_triggered = False
     _document_name = "Untitled"
@@ -272,6 +279,8 @@ class MainWindow(QApplication):
         self.window.actionSaturation.triggered.connect(self.filter_saturation.show)
         self.filter_color_balance = FilterColorBalance(parent=self)
         self.window.actionColor_Balance.triggered.connect(self.filter_color_balance.show)
+        self.filter_grain = FilterGrain(parent=self)
+        self.window.actionGrain.triggered.connect(self.filter_grain.show)
 
         # initialize sizes
         self.window.width_slider.setValue(self.width)
@@ -314,6 +323,9 @@ class MainWindow(QApplication):
         self.initialize_stable_diffusion()
 
         self.window.actionResize_on_Paste.triggered.connect(self.toggle_resize_on_paste)
+        self.window.actionAdjustment_Layers.triggered.connect(self.toggle_filters_as_adjustments)
+        self.window.actionRemove_Adjustment.triggered.connect(lambda: self.canvas.remove_adjustment())
+        self.window.actionClear_Adjustments.triggered.connect(self.canvas.clear_adjustments)
 
         # set tool button based on current tool
         if self.canvas.active_grid_area_selected:
@@ -423,6 +435,9 @@ class MainWindow(QApplication):
     def toggle_resize_on_paste(self):
         self.settings_manager.settings.resize_on_paste.set(self.window.actionResize_on_Paste.isChecked())
 
+    def toggle_filters_as_adjustments(self):
+        self.filters_as_adjustments = self.window.actionAdjustment_Layers.isChecked()
+
     def initialize_shortcuts(self):
         # on shift + mouse scroll change working width
         self.window.wheelEvent = self.change_width
@@ -693,12 +708,17 @@ class MainWindow(QApplication):
             last_event["lines"] = self.canvas.layers[last_event["layer_index"]].lines[start_line_index:end_line_index]
             self.history.undone_history.append(last_event)
             del self.canvas.layers[last_event["layer_index"]].lines[start_line_index:end_line_index]
+            self.canvas.layers[last_event["layer_index"]].stroke_cache.invalidate()
             self.canvas.update()
         elif event_name == "erase":
             # add lines to layer
-            lines = self.canvas.layers[last_event["layer_index"]].lines
-            self.canvas.layers[last_event["layer_index"]].lines = last_event["lines"]
-            last_event["lines"] = lines
+            if "lines" in last_event:
+                lines = self.canvas.layers[last_event["layer_index"]].lines
+                self.canvas.layers[last_event["layer_index"]].lines = last_event["lines"]
+                last_event["lines"] = lines
+            # put back the tiles the eraser touched
+            if "tiles" in last_event:
+                last_event["tiles"] = last_event["image_data"].tiles.restore(last_event["tiles"])
             self.history.undone_history.append(last_event)
             self.canvas.update()
         elif event_name == "new_layer":
@@ -740,6 +760,13 @@ class MainWindow(QApplication):
             self.canvas.layers[last_event["layer_index"]].images = images
             self.history.undone_history.append(last_event)
             self.canvas.update()
+        elif event_name == "set_adjustments":
+            adjustments = self.canvas.layers[last_event["layer_index"]].adjustments
+            nodes = adjustments.nodes
+            adjustments.nodes = last_event["nodes"]
+            last_event["nodes"] = nodes
+            self.history.undone_history.append(last_event)
+            self.canvas.update()
 
     def redo(self):
         if len(self.history.undone_history) == 0:
@@ -748,11 +775,15 @@ class MainWindow(QApplication):
         event_name = undone_event["event"]
         if event_name == "draw":
             lines = undone_event["lines"]
+            # appended lines are added to the stroke cache on the next paint
             self.canvas.layers[undone_event["layer_index"]].lines.extend(lines)
         elif event_name == "erase":
-            lines = self.canvas.layers[undone_event["layer_index"]].lines
-            self.canvas.layers[undone_event["layer_index"]].lines = undone_event["lines"]
-            undone_event["lines"] = lines
+            if "lines" in undone_event:
+                lines = self.canvas.layers[undone_event["layer_index"]].lines
+                self.canvas.layers[undone_event["layer_index"]].lines = undone_event["lines"]
+                undone_event["lines"] = lines
+            if "tiles" in undone_event:
+                undone_event["tiles"] = undone_event["image_data"].tiles.restore(undone_event["tiles"])
         elif event_name == "new_layer":
             self.canvas.layers.insert(0, undone_event["layer"])
             self.canvas.current_layer_index = undone_event["layer_index"]
@@ -786,6 +817,11 @@ class MainWindow(QApplication):
             undone_event["previous_image_pivot_point"] = current_image_pivot_point
             self.canvas.layers[undone_event["layer_index"]].images = images
             self.canvas.update()
+        elif event_name == "set_adjustments":
+            adjustments = self.canvas.layers[undone_event["layer_index"]].adjustments
+            nodes = adjustments.nodes
+            adjustments.nodes = undone_event["nodes"]
+            undone_event["nodes"] = nodes
         self.canvas.update()
         self.history.event_history.append(undone_event)
 
@@ -885,14 +921,35 @@ class MainWindow(QApplication):
             error_var=self.error_var,
             message_var=self.message_var,
         )
+        # let the workers finish instead of killing their threads on exit
+        self.aboutToQuit.connect(self.client.stop_workers)
 
     def image_handler(self, image, data, nsfw_content_detected):
         self.stop_progress_bar(data["action"])
+        if not self.client.wants_result(data):
+            return
         if nsfw_content_detected and self.settings_manager.settings.nsfw_filter.get():
             self.message_handler("NSFW content detected, try again.", error=True)
         else:
             self.canvas.image_handler(image, data)
             self.message_handler("")
+            self.show_queue_status()
+
+    def show_queue_status(self):
+        depth = self.client.queue_depth()
+        if depth:
+            self.window.status_label.setStyleSheet("color: black;")
+            self.window.status_label.setText(f"{depth} request{'s' if depth > 1 else ''} queued")
+
+    def interrupt(self):
+        """
+        Cancel the last generate request, whether it is queued or running.
+        """
+        if self.last_job_id is not None:
+            self.client.cancel(self.last_job_id)
+            self.last_job_id = None
+        self.message_handler("")
+        self.show_queue_status()
 
     def update_canvas_color(self, color):
         self.window.canvas.setStyleSheet(f"background-color: {color};")
@@ -1033,6 +1090,7 @@ class MainWindow(QApplication):
             # if samples is greater than 1 enable the interrupt_button
             if tab.samples_spinbox.value() > 1:
                 tab.interrupt_button.setEnabled(tab.samples_spinbox.value() > 1)
+            tab.interrupt_button.clicked.connect(self.interrupt)
 
             self.set_default_values(tab_name, tab)
 
@@ -1309,32 +1367,6 @@ class MainWindow(QApplication):
         if self.use_pixels:
             self.requested_image = image
             self.start_progress_bar(self.current_section)
-            try:
-                image = self.canvas.current_layer.images[0].image
-            except IndexError:
-                image = None
-
-            if image is None:
-                # create a transparent image the size of self.canvas.active_grid_area_rect
-                width = self.settings_manager.settings.working_width.get()
-                height = self.settings_manager.settings.working_height.get()
-                image = Image.new("RGBA", (int(width), int(height)), (0, 0, 0, 0))
-
-            lines = self.canvas.current_layer.lines
-            # combine lines with image
-            for line in lines:
-                # convert PIL.Image to numpy array
-                image = np.array(image)
-                start: QPoint = line.start_point
-                end: QPoint = line.end_point
-                color: QColor = line._pen["color"]
-                image = cv2.line(image, (start.x(), start.y()), (end.x(), end.y()), (color.red(), color.green(), color.blue()), int(line._pen["width"]))
-                # convert numpy array to PIL.Image
-                image = Image.fromarray(image)
-
-            img = image.copy().convert("RGBA")
-            new_image = Image.new("RGBA", (self.settings.working_width.get(), self.settings.working_height.get()), (0, 0, 0))
-
             cropped_outpaint_box_rect = self.active_rect()
             crop_location = (
                 cropped_outpaint_box_rect.x() - self.canvas.image_pivot_point.x(),
@@ -1342,23 +1374,17 @@ class MainWindow(QApplication):
                 cropped_outpaint_box_rect.width() - self.canvas.image_pivot_point.x(),
                 cropped_outpaint_box_rect.height() - self.canvas.image_pivot_point.y()
             )
-            new_image.paste(img.crop(crop_location), (0, 0))
-            # save new_image to disc
-            mask = Image.new("RGB", (new_image.width, new_image.height), (255, 255, 255))
-            for x in range(new_image.width):
-                for y in range(new_image.height):
-                    try:
-                        if new_image.getpixel((x, y))[3] != 0:
-                            mask.putpixel((x, y), (0, 0, 0))
-                    except IndexError:
-                        pass
-
-            # convert image to rgb
-            image = new_image.convert("RGB")
-
+            # only a copy-on-write snapshot is taken here, the image and mask
+            # are prepared on the request thread
+            generate_input = GenerateInput(
+                self.canvas.current_layer,
+                crop_location,
+                (int(self.settings.working_width.get()), int(self.settings.working_height.get())),
+                mask_dilation=self.mask_dilation,
+                mask_feather=self.mask_feather
+            )
             self.do_generate({
-                "mask": mask,
-                "image": image,
+                "prepare": generate_input.prepare,
                 "location": self.canvas.active_grid_area_rect
             })
         elif self.action == "vid2vid":
@@ -1402,6 +1428,7 @@ class MainWindow(QApplication):
         sm = self.settings_manager.settings
         sm.set_namespace(action)
 
+        random_seed = sm.random_seed.get() or self.random_seed
         if sm.random_seed.get():
             # randomize seed
             seed = random.randint(0, MAX_SEED)
@@ -1504,7 +1531,11 @@ class MainWindow(QApplication):
             }
         }
 
-        self.client.message = data
+        # with a random seed every click asks for another image, only
+        # requests with a fixed seed replace the pending one
+        self.last_job_id = self.client.submit(data, supersede=not random_seed)
+        self.tabs[action].interrupt_button.setEnabled(True)
+        self.show_queue_status()
 
     def active_rect(self):
         rect = QRect(
@@ -0,0 +1,24 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def alpha_mask(image, threshold=0, dilation=0, feather=0):
+    """
+    Return the inpainting mask of an RGBA image as an RGB image, white
+    where there is nothing to keep (alpha at most threshold) and black
+    where the image has pixels.
+
+    :param dilation: grow the white area by this many pixels so the
+        generated pixels overlap the edge of the existing ones
+    :param feather: soften the edge of the mask over about this many pixels
+    """
+    alpha = np.asarray(image.getchannel("A"))
+    mask = np.where(alpha > threshold, 0, 255).astype(np.uint8)
+    if dilation > 0:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * dilation + 1, 2 * dilation + 1))
+        mask = cv2.dilate(mask, kernel)
+    if feather > 0:
+        # three standard deviations cover nearly all of the blur
+        mask = cv2.GaussianBlur(mask, (0, 0), feather / 3)
+    return Image.fromarray(mask, "L").convert("RGB")
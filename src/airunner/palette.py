@@ -0,0 +1,64 @@
+import numpy as np
+
+# pixels compared against the palette at a time, bounds the distance matrix
+CHUNK_PIXELS = 65536
+
+
+def nearest(pixels, palette):
+    """
+    Return the index of the nearest palette color for every (n, 3) pixel.
+    """
+    palette = palette.astype(np.int32)
+    palette_norms = (palette ** 2).sum(axis=1)
+    labels = np.empty(len(pixels), dtype=np.int32)
+    for start in range(0, len(pixels), CHUNK_PIXELS):
+        chunk = pixels[start:start + CHUNK_PIXELS].astype(np.int32)
+        # |p - c|^2 without the |p|^2 term, which is the same for every color
+        distances = palette_norms[None, :] - 2 * chunk @ palette.T
+        labels[start:start + CHUNK_PIXELS] = distances.argmin(axis=1)
+    return labels
+
+
+def median_cut(pixels, colors):
+    """
+    Return a palette of at most colors colors for (n, 3) uint8 pixels. The
+    box with the widest channel is split at its median until there are
+    colors boxes, every box contributes its mean color.
+    """
+    boxes = [pixels]
+    spans = [_span(pixels)]
+    while len(boxes) < colors:
+        index = int(np.argmax([span.max() for span in spans]))
+        if spans[index].max() == 0:
+            break
+        box = boxes.pop(index)
+        channel = int(np.argmax(spans.pop(index)))
+        middle = len(box) // 2
+        order = np.argpartition(box[:, channel], middle)
+        for half in (box[order[:middle]], box[order[middle:]]):
+            boxes.append(half)
+            spans.append(_span(half))
+    return np.array([np.rint(box.mean(axis=0)) for box in boxes], dtype=np.uint8)
+
+
+def _span(box):
+    if len(box) < 2:
+        return np.zeros(3, dtype=np.int32)
+    return box.max(axis=0).astype(np.int32) - box.min(axis=0)
+
+
+def kmeans(pixels, colors, iterations=8):
+    """
+    Return a palette of at most colors colors for (n, 3) uint8 pixels, k-means
+    refined from the median cut palette.
+    """
+    palette = median_cut(pixels, colors).astype(np.float64)
+    values = pixels.astype(np.float64)
+    for _ in range(iterations):
+        labels = nearest(pixels, np.rint(palette))
+        counts = np.bincount(labels, minlength=len(palette))
+        used = counts > 0
+        for channel in range(3):
+            sums = np.bincount(labels, weights=values[:, channel], minlength=len(palette))
+            palette[used, channel] = sums[used] / counts[used]
+    return np.clip(np.rint(palette), 0, 255).astype(np.uint8)
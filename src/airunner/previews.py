@@ -0,0 +1,130 @@
+import copy
+import threading
+from PyQt6 import QtCore
+from PIL import Image
+from tiled_filter import apply_tiled
+from filter_cache import filter_cache
+
+
+def proxy_filter(image_filter, scale):
+    """
+    Return a filter which looks the same on an image scaled by scale as
+    image_filter does on the full image. Filters may provide scaled(scale),
+    filters with a pixel radius get their radius scaled, other filters are
+    returned as is.
+    """
+    if scale == 1.0:
+        return image_filter
+    scaled = getattr(image_filter, "scaled", None)
+    if scaled is not None:
+        return scaled(scale)
+    radius = getattr(image_filter, "radius", None)
+    if not isinstance(radius, (int, float)):
+        return image_filter
+    image_filter = copy.copy(image_filter)
+    image_filter.radius = radius * scale
+    return image_filter
+
+
+class FilterPreview(QtCore.QObject):
+    """
+    Renders filter previews on a worker thread.
+
+    Only the latest submitted job matters: a job waiting to run is replaced
+    by the next submit and the result of a job which was overtaken while it
+    ran is thrown away. ready is emitted when a current result is available.
+    Finished previews go into the shared filter cache so going back to an
+    earlier slider position does not filter again.
+    """
+    ready = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.condition = threading.Condition()
+        self.job = None
+        self.key = None
+        self.result = None
+        self.thread = None
+        self.jobs_started = 0
+        self.jobs_dropped = 0
+
+    def submit(self, key, source, image_filter, scale, source_scale=1.0):
+        """
+        Filter an image, scaled by scale, in the background. key identifies
+        the job, a job is not submitted twice while its result is current.
+        Returns the preview right away when it is in the filter cache.
+        :param source: called on a cache miss, it takes a snapshot of the
+            pixels and returns a function reading the image from it, which is
+            called on the worker thread
+        :param source_scale: the scale of the image read from source, such
+            as a pyramid level, it is only resized by what remains
+        """
+        with self.condition:
+            if key == self.key:
+                return self.current(key)
+            cached = filter_cache.get(key)
+            if cached is not None:
+                if self.job is not None:
+                    self.jobs_dropped += 1
+                self.job = None
+                self.key = key
+                self.result = (key, cached)
+                return cached
+            if self.job is not None:
+                self.jobs_dropped += 1
+            self.key = key
+            self.job = (key, source(), image_filter, scale, source_scale)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="filter preview", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return None
+
+    def current(self, key):
+        """
+        Return the preview image for key or None if it is not ready.
+        """
+        result = self.result
+        if result is not None and result[0] == key:
+            return result[1]
+        return None
+
+    def latest(self):
+        """
+        Return (key, image) of the last finished preview or None.
+        """
+        return self.result
+
+    def clear(self):
+        with self.condition:
+            self.job = None
+            self.key = None
+            self.result = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None:
+                    self.condition.wait()
+                key, read, image_filter, scale, source_scale = self.job
+                self.job = None
+            self.jobs_started += 1
+            image = read()
+            if scale != source_scale:
+                resize = scale / source_scale
+                image = image.resize(
+                    (max(1, int(image.width * resize)), max(1, int(image.height * resize))),
+                    Image.BILINEAR
+                )
+            image = apply_tiled(image, proxy_filter(image_filter, scale), is_cancelled=lambda: key != self.key)
+            if image is None:
+                self.jobs_dropped += 1
+                continue
+            with self.condition:
+                if key != self.key:
+                    # the slider moved while this job ran
+                    self.jobs_dropped += 1
+                    continue
+                self.result = (key, image)
+            filter_cache.put(key, image)
+            self.ready.emit()
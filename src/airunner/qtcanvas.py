@@ -1,20 +1,142 @@
 import io
+import logging
+import math
 import subprocess
 import uuid
 import PIL
+import numpy as np
 from PIL import Image, ImageOps, ImageDraw, ImageGrab
 from PIL.ImageQt import ImageQt
-from PyQt6.QtCore import Qt, QPoint, QRect, QPointF
-from PyQt6.QtGui import QColor, QPainter, QPen, QBrush, QPixmap, QCursor, QPainterPath, QPolygonF
+from PyQt6.QtCore import Qt, QPoint, QRect, QPointF, QRectF, QLineF
+from PyQt6.QtGui import QColor, QPainter, QPen, QBrush, QPixmap, QCursor, QPainterPath, QPolygonF, \
+    QImage
+from tiles import TileGrid, MAX_LEVEL
+from strokes import StrokeStore
+from repaint import RepaintScheduler
+from previews import FilterPreview
+from filter_job import FilterJob
+from color_ops import ColorPipeline
+from filter_cache import filter_key
+from adjustments import AdjustmentStack, AdjustmentRenderer
 
 
 class ImageData:
-    def __init__(self, position: QPoint, image: Image):
+    """
+    An image on a layer. The pixels are stored in a sparse TileGrid in canvas
+    coordinates, position and size describe the bounds of the image.
+    """
+    # pixmap cache statistics shared by all ImageData objects
+    pixmap_cache_hits = 0
+    pixmap_cache_misses = 0
+
+    @property
+    def image(self):
+        """
+        The full image as a PIL image. This composes every tile, prefer
+        crop() or the tiles directly when only part of the image is needed.
+        """
+        return self.tiles.crop(self.rect)
+
+    @image.setter
+    def image(self, image):
+        self.tiles.clear()
+        self.width = image.width
+        self.height = image.height
+        self.tiles.paste(image, (self.position.x(), self.position.y()))
+
+    @property
+    def version(self):
+        return self.tiles.version
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def rect(self):
+        return (
+            self.position.x(),
+            self.position.y(),
+            self.position.x() + self.width,
+            self.position.y() + self.height
+        )
+
+    def tile_pixmap(self, key, level=0):
+        """
+        Return a tile of the given pyramid level as a QPixmap, converting it
+        only when the tiles under it have changed since the last call.
+        """
+        version = self.tiles.level_signature(level, key)
+        cached = self._pixmaps.get((level, key))
+        if cached is None or cached[0] != version:
+            tile = self.tiles.level_tile(level, key)
+            if tile is None:
+                return None
+            ImageData.pixmap_cache_misses += 1
+            pixmap = QPixmap.fromImage(ImageQt(tile))
+            self._pixmaps[(level, key)] = (version, pixmap)
+            return pixmap
+        ImageData.pixmap_cache_hits += 1
+        return cached[1]
+
+    def __init__(self, position: QPoint, image: Image = None, tiles: TileGrid = None, size=None):
         self.position = position
-        self.image = image
+        self._pixmaps = {}
+        if tiles is not None:
+            self.tiles = tiles
+            self.width, self.height = size
+        else:
+            self.tiles = TileGrid()
+            self.image = image
+
+    def copy(self):
+        """
+        Return a copy sharing unchanged tiles with this image.
+        """
+        image_data = ImageData(QPoint(self.position), tiles=self.tiles.copy(), size=self.size)
+        # cached pixmaps are checked against tile versions, unchanged tiles keep theirs
+        image_data._pixmaps = self._pixmaps.copy()
+        return image_data
+
+    def crop(self, box):
+        return self.tiles.crop(box)
+
+    def invalidate(self):
+        """
+        Mark the cached pixmaps as stale, use after modifying tiles in place.
+        """
+        self.tiles.touch()
+
+    def __getstate__(self):
+        # QPixmap cannot be pickled, it is rebuilt on the next paint
+        state = self.__dict__.copy()
+        state["_pixmaps"] = {}
+        return state
+
+    def __setstate__(self, state):
+        # documents saved before tiled storage kept a single PIL image
+        image = state.pop("image", None) or state.pop("_image", None)
+        for key in ("version", "_pixmap", "_pixmap_version"):
+            state.pop(key, None)
+        state["_pixmaps"] = {}
+        self.__dict__.update(state)
+        if image is not None:
+            self.tiles = TileGrid()
+            self.image = image
+
+    @staticmethod
+    def pixmap_cache_stats():
+        return {
+            "hits": ImageData.pixmap_cache_hits,
+            "misses": ImageData.pixmap_cache_misses,
+        }
 
 
 class LineData:
+    """
+    A single brush segment. Layers keep their segments in a StrokeStore,
+    this class is only kept to load documents saved before that.
+    """
     @property
     def pen(self):
         pen = self._pen if self._pen else {
@@ -39,12 +161,147 @@ class LineData:
         }
         self.layer_index = layer_index
 
-    def intersects(self, start: QPoint, brush_size: int):
-        # check x and use brush size
-        if self.start_point.x() > start.x() - brush_size and self.start_point.x() < start.x() + brush_size:
-            if self.start_point.y() > start.y() - brush_size and self.start_point.y() < start.y() + brush_size:
-                return True
-        return False
+    @property
+    def pen_key(self):
+        pen = self.pen
+        return pen.color().rgba(), pen.width(), pen.style().value
+
+
+def qimage_to_pil(qimage: QImage):
+    qimage = qimage.convertToFormat(QImage.Format.Format_RGBA8888)
+    data = qimage.constBits()
+    data.setsize(qimage.sizeInBytes())
+    return Image.frombuffer(
+        "RGBA", (qimage.width(), qimage.height()), bytes(data), "raw", "RGBA", qimage.bytesPerLine(), 1
+    )
+
+
+def pil_to_qimage(image: Image):
+    data = image.convert("RGBA").tobytes("raw", "RGBA")
+    # copy so the QImage does not point at the temporary bytes object
+    return QImage(data, image.width, image.height, image.width * 4, QImage.Format.Format_RGBA8888).copy()
+
+
+_pens = {}
+
+
+def store_pen(pen_key):
+    """
+    Return the QPen for an (rgba, width, style) entry of a StrokeStore pen
+    table, pens are shared between segments with the same style.
+    """
+    pen = _pens.get(pen_key)
+    if pen is None:
+        rgba, width, style = pen_key
+        pen = QPen(QColor.fromRgba(rgba), width, Qt.PenStyle(style))
+        pen.setCapStyle(Qt.PenCapStyle.RoundCap)
+        _pens[pen_key] = pen
+    return pen
+
+
+def draw_segments(painter, strokes: StrokeStore, indices, offset: QPointF):
+    """
+    Draw the segments of a StrokeStore at indices. Consecutive segments with
+    the same pen are submitted in a single drawLines call so overlapping
+    strokes keep their drawing order.
+    """
+    if len(indices) == 0:
+        return
+    segments = strokes.segments[indices] + np.array(
+        [offset.x(), offset.y(), offset.x(), offset.y()]
+    )
+    pen_ids = strokes.pen_ids[indices]
+    runs = np.concatenate(([0], np.flatnonzero(pen_ids[1:] != pen_ids[:-1]) + 1, [len(pen_ids)]))
+    for first, last in zip(runs[:-1], runs[1:]):
+        painter.setPen(store_pen(strokes.pens[pen_ids[first]]))
+        painter.drawLines([QLineF(*segment) for segment in segments[first:last].tolist()])
+
+
+class StrokeCache:
+    """
+    Raster cache of the committed brush strokes of a layer.
+
+    The first line_count lines of the layer are rendered into tiles, lines
+    after that (the stroke being drawn) are drawn as vectors by the canvas.
+    """
+    def __init__(self):
+        self.image = ImageData(QPoint(0, 0), tiles=TileGrid(), size=(0, 0))
+        self.line_count = 0
+        self.dirty_keys = set()
+
+    def invalidate(self):
+        """
+        Throw the cache away, it is rebuilt on the next refresh.
+        """
+        self.image = ImageData(QPoint(0, 0), tiles=TileGrid(), size=(0, 0))
+        self.line_count = 0
+        self.dirty_keys = set()
+
+    def invalidate_box(self, box):
+        """
+        Re-render the tiles under a box on the next refresh.
+        """
+        self.dirty_keys.update(self.image.tiles.keys_in_box(box))
+
+    def refresh(self, strokes: StrokeStore, committed):
+        """
+        Bring the cache up to date with the first committed segments.
+        """
+        if self.line_count > committed:
+            # segments were removed from the end without telling the cache
+            self.invalidate()
+        if self.dirty_keys:
+            keys = self.dirty_keys
+            self.dirty_keys = set()
+            self.render(strokes, 0, self.line_count, keys)
+        if committed > self.line_count:
+            self.render(strokes, self.line_count, committed)
+            self.line_count = committed
+
+    def render(self, strokes: StrokeStore, start, end, keys=None):
+        """
+        Rasterize the segments from start to end into the tiles they cover.
+        When keys is given those tiles are rendered again from scratch with
+        the segments that touch them, otherwise the segments are painted on
+        top of the existing tiles.
+        """
+        tiles = self.image.tiles
+        size = tiles.tile_size
+        boxes = strokes.boxes(slice(start, end))
+        first_x = boxes[:, 0] // size
+        first_y = boxes[:, 1] // size
+        last_x = (boxes[:, 2] - 1) // size
+        last_y = (boxes[:, 3] - 1) // size
+
+        if keys is None:
+            # every tile touched by a segment, segments rarely span more than a few
+            covered = set()
+            span_x = last_x - first_x
+            span_y = last_y - first_y
+            for dy in range(int(span_y.max(initial=-1)) + 1):
+                for dx in range(int(span_x.max(initial=-1)) + 1):
+                    mask = (span_x >= dx) & (span_y >= dy)
+                    covered.update(zip((first_x[mask] + dx).tolist(), (first_y[mask] + dy).tolist()))
+            keys = covered
+            from_scratch = False
+        else:
+            from_scratch = True
+
+        for key in keys:
+            indices = start + np.flatnonzero(
+                (first_x <= key[0]) & (last_x >= key[0]) & (first_y <= key[1]) & (last_y >= key[1])
+            )
+            existing = tiles.get_tile(key)
+            if not from_scratch and existing is not None:
+                qimage = pil_to_qimage(existing)
+            else:
+                qimage = QImage(size, size, QImage.Format.Format_RGBA8888)
+                qimage.fill(Qt.GlobalColor.transparent)
+            if len(indices):
+                painter = QPainter(qimage)
+                draw_segments(painter, strokes, indices, QPointF(-key[0] * size, -key[1] * size))
+                painter.end()
+            tiles.set_tile(key, qimage_to_pil(qimage) if len(indices) else None)
 
 
 class LayerData:
@@ -54,6 +311,29 @@ class LayerData:
             return self.images[0]
         return None
 
+    def flattened_image(self):
+        """
+        The first image with the adjustments applied, as it is saved and
+        sent to the generator.
+        """
+        image = self.image
+        if image is None or not self.adjustments:
+            return image
+        return self.adjustments.flatten(image)
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        # lists of LineData come from older documents and from clearing the layer
+        if not isinstance(lines, StrokeStore):
+            lines = StrokeStore.from_lines(lines)
+        # replacing the lines makes the stroke raster cache stale
+        self._lines = lines
+        self.stroke_cache.invalidate()
+
     def __init__(
         self,
         index: int,
@@ -67,14 +347,33 @@ class LayerData:
         self.visible = visible
         self.opacity = opacity
         self.offset = offset
+        self.stroke_cache = StrokeCache()
         self.lines = []
         self.images = []
+        # filters drawn on top of the images without changing them
+        self.adjustments = AdjustmentStack()
         self.uuid = uuid.uuid4()
 
+    def __getstate__(self):
+        # the stroke cache is rebuilt from the lines after loading
+        state = self.__dict__.copy()
+        state.pop("stroke_cache", None)
+        return state
+
+    def __setstate__(self, state):
+        if "lines" in state:
+            state["_lines"] = state.pop("lines")
+        if not isinstance(state.get("_lines"), StrokeStore):
+            state["_lines"] = StrokeStore.from_lines(state.get("_lines") or [])
+        state.setdefault("adjustments", AdjustmentStack())
+        self.__dict__.update(state)
+        self.stroke_cache = StrokeCache()
+
     def clear(self, index):
         self.index = index
         self.lines = []
         self.images = []
+        self.adjustments = AdjustmentStack()
         self.visible = True
         self.opacity = 1.0
         self.name = f"Layer {self.index + 1}"
@@ -82,17 +381,111 @@ class LayerData:
 
 class Canvas:
     saving = False
+    paint_rect = QRect(0, 0, 0, 0)
+    min_zoom = 1 / 32
+    max_zoom = 8.0
+    zoom_step = 1.25
     select_start = None
     select_end = None
 
     def set_current_layer(self, index):
         self.current_layer_index = index
 
-    def apply_filter(self):
-        index = 0
-        for image in self.current_layer.images:
-            self.current_layer.images[index].image = image.image.filter(self.parent.current_filter)
-            index += 1
+    def apply_filter(self, image_filter=None):
+        """
+        Apply a filter (the current filter by default) to every image of the
+        current layer on a worker thread. Returns the FilterJob or None when
+        there is nothing to filter. The filtered images replace the layer
+        images in one step, with a single history entry, when the job
+        finishes.
+        """
+        image_filter = image_filter or self.parent.current_filter
+        layer = self.current_layer
+        images = list(layer.images)
+        if image_filter is None or not images:
+            return None
+        versions = [image.version for image in images]
+        key = filter_key(image_filter)
+        # the worker reads copy-on-write snapshots, edits made while it runs do not reach them
+        snapshots = [image.copy() for image in images]
+        job = FilterJob(
+            [lambda snapshot=snapshot: snapshot.image for snapshot in snapshots],
+            image_filter,
+            # the same keys as a preview of the whole image at full resolution
+            keys=[(key, image.version, image.rect, 1.0) if key else None for image in images],
+            output=lambda index, filtered: ImageData(QPoint(images[index].position), filtered),
+            parent=self.canvas_container
+        )
+        job.finished.connect(lambda results: self.finish_filter(job, layer, images, versions, results))
+        job.start()
+        self.filter_job = job
+        return job
+
+    def finish_filter(self, job, layer, images, versions, results):
+        if self.filter_job is job:
+            self.filter_job = None
+        if job.is_cancelled:
+            return
+        # the layer was edited while the filter ran, keep the edits
+        if layer.images != images or [image.version for image in images] != versions:
+            logging.getLogger().warning("Filter result dropped, the layer was edited while the filter ran")
+            self.parent.message_handler({"response": "Filter not applied, the layer changed while it ran"})
+            return
+        self.parent.history.add_event({
+            "event": "set_image",
+            "layer_index": self.layers.index(layer) if layer in self.layers else self.current_layer_index,
+            "images": images,
+            "previous_image_root_point": self.image_root_point,
+            "previous_image_pivot_point": self.image_pivot_point,
+        })
+        layer.images = results
+        self.update()
+
+    def add_adjustment(self, image_filter=None):
+        """
+        Add a filter (the current filter by default) to the adjustments of
+        the current layer, the layer images are not changed.
+        """
+        image_filter = image_filter or self.parent.current_filter
+        if image_filter is None:
+            return
+        self.track_adjustment_history()
+        self.current_layer.adjustments.add(image_filter)
+        self.update()
+
+    def set_adjustment(self, index, image_filter):
+        """
+        Replace the filter of an adjustment of the current layer, only the
+        adjustments from index on are computed again.
+        """
+        self.track_adjustment_history()
+        self.current_layer.adjustments.replace(index, image_filter)
+        self.update()
+
+    def remove_adjustment(self, index=-1):
+        """
+        Remove an adjustment of the current layer, the last one by default.
+        """
+        adjustments = self.current_layer.adjustments
+        if not adjustments:
+            return
+        self.track_adjustment_history()
+        adjustments.remove(index % len(adjustments))
+        self.update()
+
+    def clear_adjustments(self):
+        if not self.current_layer.adjustments:
+            return
+        self.track_adjustment_history()
+        self.current_layer.adjustments.nodes = []
+        self.update()
+
+    def track_adjustment_history(self):
+        self.parent.history.add_event({
+            "event": "set_adjustments",
+            "layer_index": self.current_layer_index,
+            "nodes": self.current_layer.adjustments.nodes,
+        })
 
     def delete_layer(self, index):
         self.parent.history.add_event({
@@ -212,7 +605,7 @@ class Canvas:
 
     @property
     def is_zooming(self):
-        return False
+        return self.zoom != 1.0
 
     @property
     def grid_size(self):
@@ -242,10 +635,14 @@ class Canvas:
         self.canvas_rect = QRect(0, 0, 0, 0)
         self.pos_x = 0
         self.pos_y = 0
+        self.zoom = 1.0
         self.layers = []
         self.current_layer_index = 0
         self.active_grid_area_pivot_point = QPoint(0, 0)
         self.is_erasing = False
+        self.erase_event = None
+        self.is_drawing = False
+        self.filter_job = None
         self.start_drawing_line_index = 0
         self.stop_drawing_line_index = 0
 
@@ -257,6 +654,15 @@ class Canvas:
         self.image_root_point = QPoint(0, 0)
 
         self.canvas_container = parent.window.canvas_container
+        self.repaint_scheduler = RepaintScheduler(self.canvas_container)
+        self.filter_preview = FilterPreview(self.canvas_container)
+        self.filter_preview.ready.connect(self.update)
+        self.adjustment_renderer = AdjustmentRenderer(self.canvas_container)
+        self.adjustment_renderer.ready.connect(self.update)
+        self.adjustment_renderer.failed.connect(
+            lambda message: self.parent.error_handler(f"Adjustment failed: {message}")
+        )
+        self._preview_pixmap = None
 
         # Set initial position and size of the canvas
         self.canvas_container.setGeometry(QRect(
@@ -271,6 +677,7 @@ class Canvas:
         self.canvas_container.mousePressEvent = self.mouse_press_event
         self.canvas_container.mouseMoveEvent = self.mouse_move_event
         self.canvas_container.mouseReleaseEvent = self.mouse_release_event
+        self.canvas_container.wheelEvent = self.wheel_event
         # on mouse hover
         self.canvas_container.enterEvent = self.enter_event
         self.canvas_container.leaveEvent = self.leave_event
@@ -331,7 +738,7 @@ class Canvas:
         """
         section = data["action"] if not section else section
         outpaint_box_rect = data["options"]["outpaint_box_rect"]
-        processed_image, image_root_point, image_pivot_point = self.handle_outpaint(
+        image_data, image_root_point, image_pivot_point = self.handle_outpaint(
             outpaint_box_rect, processed_image, section
         )
         history_event = {
@@ -344,87 +751,69 @@ class Canvas:
         self.parent.history.add_event(history_event)
         self.image_root_point = image_root_point
         self.image_pivot_point = image_pivot_point
-        self.current_layer.images = [ImageData(image_pivot_point, processed_image)]
+        self.current_layer.images = [image_data]
 
     def handle_outpaint(self, outpaint_box_rect, outpainted_image, action):
         if len(self.current_layer.images) == 0:
-            return outpainted_image, self.image_root_point, self.image_pivot_point
+            image_data = ImageData(QPoint(self.image_pivot_point), outpainted_image)
+            return image_data, self.image_root_point, self.image_pivot_point
 
-        # make a copy of the current canvas image
-        existing_image_copy = self.current_layer.images[0].image.copy()
-        width = existing_image_copy.width
-        height = existing_image_copy.height
-        working_width = self.settings_manager.settings.working_width.get()
-        working_height = self.settings_manager.settings.working_height.get()
+        # the new image shares its tiles with the current image, pasting the
+        # outpainted image only writes the tiles covered by the outpaint box
+        existing_image = self.current_layer.images[0]
+        image_data = existing_image.copy()
+        width = existing_image.width
+        height = existing_image.height
 
         is_drawing_left = outpaint_box_rect.x() < self.image_pivot_point.x()
         is_drawing_up = outpaint_box_rect.y() < self.image_pivot_point.y()
 
-        if is_drawing_left:
-            # get the x overlap of the outpaint box and the image
-            x_overlap = min(width, outpaint_box_rect.width()) - max(0, outpaint_box_rect.x())
-        else:
-            # get the x overlap of the outpaint box and the image
-            x_overlap = min(width, outpaint_box_rect.width()) - max(0, outpaint_box_rect.x() - self.image_pivot_point.x())
-
-        if is_drawing_up:
-            # get the y overlap of the outpaint box and the image
-            y_overlap = min(height, outpaint_box_rect.height()) - max(0, outpaint_box_rect.y())
-        else:
-            # get the y overlap of the outpaint box and the image
-            y_overlap = min(height, outpaint_box_rect.height()) - max(0, outpaint_box_rect.y() - self.image_pivot_point.y())
-
-        # get the x and y overlap of the outpaint box and the image
-        new_dimensions = (int(width + working_width - x_overlap), int(height + working_height - y_overlap))
-        if new_dimensions[0] < width:
-            new_dimensions = (width, new_dimensions[1])
-        if new_dimensions[1] < height:
-            new_dimensions = (new_dimensions[0], height)
-        new_image = Image.new("RGBA", new_dimensions, (0, 0, 0, 0))
-        new_image_a = Image.new("RGBA", new_dimensions, (0, 0, 0, 0))
-        new_image_b = Image.new("RGBA", new_dimensions, (0, 0, 0, 0))
-        existing_image_pos = [0, 0]
         image_root_point = QPoint(self.image_root_point.x(), self.image_root_point.y())
         image_pivot_point = QPoint(self.image_pivot_point.x(), self.image_pivot_point.y())
         if is_drawing_left:
-            current_x_pos = abs(outpaint_box_rect.x() - image_pivot_point.x())
             left_overlap = abs(outpaint_box_rect.x()) - abs(image_root_point.x())
             image_root_point.setX(width + left_overlap)
             image_pivot_point.setX(int(outpaint_box_rect.x()))
-            existing_image_pos = [current_x_pos, existing_image_pos[1]]
-            pos_x = max(0, outpaint_box_rect.x() + self.image_pivot_point.x())
-        else:
-            pos_x = max(0, outpaint_box_rect.x() - self.image_pivot_point.x())
         if is_drawing_up:
-            current_y_pos = abs(outpaint_box_rect.y() - image_pivot_point.y())
             up_overlap = abs(outpaint_box_rect.y()) - abs(image_root_point.y())
             image_root_point.setY(height + up_overlap)
             image_pivot_point.setY(int(outpaint_box_rect.y()))
-            existing_image_pos = [existing_image_pos[0], current_y_pos]
-            pos_y = max(0, outpaint_box_rect.y() + self.image_pivot_point.y())
-        else:
-            pos_y = max(0, outpaint_box_rect.y() - self.image_pivot_point.y())
 
-        new_image_a.paste(outpainted_image, (int(pos_x), int(pos_y)))
-        new_image_b.paste(existing_image_copy, (int(existing_image_pos[0]), int(existing_image_pos[1])))
+        # outpainting keeps the existing pixels on top of the new image
+        image_data.tiles.paste(
+            outpainted_image,
+            (outpaint_box_rect.x(), outpaint_box_rect.y()),
+            "under" if action == "outpaint" else "over"
+        )
 
-        if action == "outpaint":
-            new_image = Image.alpha_composite(new_image, new_image_a)
-            new_image = Image.alpha_composite(new_image, new_image_b)
-        else:
-            new_image = Image.alpha_composite(new_image, new_image_b)
-            new_image = Image.alpha_composite(new_image, new_image_a)
+        # grow the bounds to the union of the existing image and the outpaint box
+        left, top, right, bottom = existing_image.rect
+        left = min(left, outpaint_box_rect.x())
+        top = min(top, outpaint_box_rect.y())
+        right = max(right, outpaint_box_rect.x() + outpainted_image.width)
+        bottom = max(bottom, outpaint_box_rect.y() + outpainted_image.height)
+        image_data.position = QPoint(int(left), int(top))
+        image_data.width = int(right - left)
+        image_data.height = int(bottom - top)
 
-        return new_image, image_root_point, image_pivot_point
+        return image_data, image_root_point, image_pivot_point
 
     def set_canvas_color(self):
         self.canvas_container.setStyleSheet(f"background-color: {self.settings_manager.settings.canvas_color.get()};")
         self.canvas_container.setAutoFillBackground(True)
 
     def paintEvent(self, event):
+        self.repaint_scheduler.paint_started()
         # Draw the grid and any lines that have been drawn by the user
         painter = QPainter(self.canvas_container)
 
+        # only what intersects the area being repainted is submitted to the painter
+        self.paint_rect = event.rect() if event else self.canvas_container.rect()
+
+        # everything below is drawn in unzoomed coordinates
+        painter.scale(self.zoom, self.zoom)
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, self.zoom < 1.0)
+
         # draw grid
         if not self.saving:
             self.draw_grid(painter)
@@ -439,6 +828,8 @@ class Canvas:
 
         if not self.saving:
             self.draw_active_grid_area_container(painter)
+        painter.end()
+        self.repaint_scheduler.paint_finished()
 
     def enter_event(self, event):
         self.update_cursor()
@@ -457,33 +848,55 @@ class Canvas:
         self.canvas_container.setCursor(QCursor(Qt.CursorShape.ArrowCursor))
 
     def update(self):
-        self.canvas_container.update()
+        # repaints are merged and paced to the display frame rate
+        self.repaint_scheduler.request()
+
+    def update_box(self, box):
+        """
+        Repaint only the part of the canvas showing a (left, top, right,
+        bottom) box of the current layer.
+        """
+        offset = QPoint(self.pos_x, self.pos_y) + self.current_layer.offset
+        left = math.floor((box[0] + offset.x()) * self.zoom) - 1
+        top = math.floor((box[1] + offset.y()) * self.zoom) - 1
+        right = math.ceil((box[2] + offset.x()) * self.zoom) + 2
+        bottom = math.ceil((box[3] + offset.y()) * self.zoom) + 2
+        self.repaint_scheduler.request(QRect(left, top, right - left, bottom - top))
 
     def draw_grid(self, painter):
         if not self.settings_manager.settings.show_grid.get():
             return
 
-        # Define the starting and ending coordinates for the grid lines
-        start_x = self.pos_x % self.grid_size
-        end_x = self.canvas_container.width()
-        start_y = self.pos_y % self.grid_size
-        end_y = self.canvas_container.height()
+        # a grid denser than a few pixels per cell is just noise
+        cell_size = self.grid_size * self.zoom
+        if cell_size < 4:
+            return
 
+        # the lines are drawn in screen coordinates on whole pixels, so they
+        # stay crisp at any zoom, with a single call for the area being repainted
         line_width = self.settings_manager.settings.line_width.get()
-        self.grid_pen.setWidth(line_width)
-        # Draw horizontal grid lines
-        y = start_y
-        while y < end_y:
-            painter.setPen(self.grid_pen)
-            painter.drawLine(0, y, self.canvas_container.width(), y)
-            y += self.grid_size
-
-        # Draw vertical grid lines
-        x = start_x
-        while x < end_x:
-            painter.setPen(self.grid_pen)
-            painter.drawLine(x, 0, x, self.canvas_container.height())
-            x += self.grid_size
+        color = QColor(self.settings_manager.settings.line_color.get())
+        rect = self.paint_rect
+        origin_x = self.pos_x * self.zoom
+        origin_y = self.pos_y * self.zoom
+        lines = []
+        first = math.floor((rect.left() - line_width - origin_x) / cell_size)
+        last = math.ceil((rect.right() + 1 - origin_x) / cell_size)
+        for index in range(first, last + 1):
+            x = round(origin_x + index * cell_size)
+            lines.append(QRectF(x, rect.top(), line_width, rect.height()))
+        first = math.floor((rect.top() - line_width - origin_y) / cell_size)
+        last = math.ceil((rect.bottom() + 1 - origin_y) / cell_size)
+        for index in range(first, last + 1):
+            y = round(origin_y + index * cell_size)
+            lines.append(QRectF(rect.left(), y, rect.width(), line_width))
+        painter.save()
+        painter.resetTransform()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, False)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(color)
+        painter.drawRects(lines)
+        painter.restore()
 
     @property
     def active_grid_area_color(self):
@@ -532,6 +945,37 @@ class Canvas:
         image = image.convert("RGBA")
         self.current_layer.images.append(ImageData(location, image))
 
+    def visible_box(self, offset: QPoint):
+        """
+        Return the (left, top, right, bottom) box, in canvas coordinates, which
+        is visible in the area being painted when drawing at offset.
+        """
+        rect = self.paint_rect
+        return (
+            int(rect.x() / self.zoom) - offset.x(),
+            int(rect.y() / self.zoom) - offset.y(),
+            int((rect.x() + rect.width()) / self.zoom) + 1 - offset.x(),
+            int((rect.y() + rect.height()) / self.zoom) + 1 - offset.y()
+        )
+
+    @property
+    def pyramid_level(self):
+        """
+        The mip pyramid level to draw at the current zoom, zoomed out views
+        draw from a smaller level instead of scaling full resolution tiles.
+        """
+        return self.level_for_scale(self.zoom)
+
+    @staticmethod
+    def level_for_scale(scale):
+        """
+        The smallest pyramid level holding at least scale times the pixels.
+        """
+        level = 0
+        while level < MAX_LEVEL and scale * (2 << level) <= 1.0:
+            level += 1
+        return level
+
     def draw_images(self, painter):
         index = 0
         layers = self.layers.copy()
@@ -539,29 +983,101 @@ class Canvas:
         for layer in layers:
             if not layer.visible:
                 continue
+            previewing = self.parent.current_filter and index == self.current_layer_index
+            if layer.adjustments:
+                layer.adjustments.prune(layer.images)
             for image in layer.images:
-                # display PIL.image as QPixmap
-                img = image.image
-                if self.parent.current_filter and index == self.current_layer_index:
-                    img = img.filter(self.parent.current_filter)
-                qimage = ImageQt(img)
-                pixmap = QPixmap.fromImage(qimage)
-
                 # apply the layer offset
-                x = image.position.x() + self.pos_x
-                y = image.position.y() + self.pos_y
-                location = QPoint(int(x), int(y)) + self.current_layer.offset
-
-                # draw the image
-                painter.drawPixmap(location, pixmap)
+                offset = QPoint(self.pos_x, self.pos_y) + self.current_layer.offset
+                left, top, right, bottom = self.visible_box(offset)
+                image_left, image_top, image_right, image_bottom = image.rect
+                if image_left >= right or image_right <= left or image_top >= bottom or image_bottom <= top:
+                    continue
+
+                if layer.adjustments:
+                    # only the visible tiles are filtered, previews of whole image filters need all of them
+                    if previewing and getattr(self.parent.current_filter, "whole_image", False):
+                        image = layer.adjustments.output(image, image.rect, self.adjustment_renderer)
+                    else:
+                        image = layer.adjustments.output(
+                            image, (left, top, right, bottom), self.adjustment_renderer, self.pyramid_level
+                        )
+
+                if previewing:
+                    self.draw_filter_preview(painter, image, offset, (left, top, right, bottom))
+                    continue
+
+                # draw the stored tiles which are on screen, empty tiles are not stored
+                self.draw_tiles(painter, image, offset, (left, top, right, bottom))
             index += 1
 
+    def draw_filter_preview(self, painter, image, offset: QPoint, box):
+        """
+        Draw the current filter applied to the visible part of an image.
+
+        Previews are rendered at screen resolution on a worker thread, until
+        the preview is ready the previous preview, or the unfiltered tiles,
+        are drawn instead. Filters with whole_image set see the whole image.
+        The source pixels are read on the worker thread from a copy-on-write
+        snapshot, from the pyramid level matching the preview scale. Whole
+        images are filtered at no more than the size of the canvas.
+        """
+        image_filter = self.parent.current_filter
+        left, top, right, bottom = image.rect
+        scale = min(1.0, self.zoom)
+        if getattr(image_filter, "whole_image", False):
+            region = image.rect
+            viewport = self.canvas_container.rect()
+            scale = min(scale, max(viewport.width(), viewport.height()) / max(1, right - left, bottom - top))
+        else:
+            region = (max(left, box[0]), max(top, box[1]), min(right, box[2]), min(bottom, box[3]))
+        level = self.level_for_scale(scale)
+        step = 1 << level
+        # align to the level pixels, the level image is transparent outside of the image
+        region = (
+            region[0] // step * step, region[1] // step * step, -(-region[2] // step) * step, -(-region[3] // step) * step
+        )
+        key = (filter_key(image_filter) or image_filter, image.version, region, scale)
+
+        def source():
+            tiles = image.tiles.copy()
+            return lambda: tiles.crop_level(level, region)
+
+        preview = self.filter_preview.submit(key, source, image_filter, scale, 1.0 / step)
+        if preview is None:
+            latest = self.filter_preview.latest()
+            if latest is None or latest[0][1] != image.version:
+                self.draw_tiles(painter, image, offset, box)
+                return
+            key, preview = latest
+            region = key[2]
+        if self._preview_pixmap is None or self._preview_pixmap[0] != key:
+            self._preview_pixmap = (key, QPixmap.fromImage(ImageQt(preview)))
+        pixmap = self._preview_pixmap[1]
+        target = QRectF(
+            region[0] + offset.x(), region[1] + offset.y(), region[2] - region[0], region[3] - region[1]
+        )
+        painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
     def invert_image(self):
-        # convert image mode to RGBA
+        # inverts the color channels in one pass and keeps alpha
+        invert = ColorPipeline.invert()
         for image in self.current_layer.images:
-            image.image = image.image.convert("RGB")
-            image.image = ImageOps.invert(image.image)
-            image.image = image.image.convert("RGBA")
+            image.image = invert.apply(image.image)
+
+    def draw_tiles(self, painter, image, offset: QPoint, box):
+        """
+        Draw the stored tiles of an image which intersect box, from the
+        pyramid level matching the current zoom.
+        """
+        level = self.pyramid_level
+        size = image.tiles.tile_size << level
+        for key in image.tiles.level_keys_in_box(level, box):
+            pixmap = image.tile_pixmap(key, level)
+            if pixmap is None:
+                continue
+            target = QRectF(key[0] * size + offset.x(), key[1] * size + offset.y(), size, size)
+            painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
 
     def draw_user_lines(self, painter):
         painter.setBrush(self.brush)
@@ -570,37 +1086,24 @@ class Canvas:
         for layer in layers:
             if not layer.visible:
                 continue
-            for line in layer.lines:
-                pen = line.pen
-                pen.setCapStyle(Qt.PenCapStyle.RoundCap)
-                painter.setPen(pen)
-                start = QPointF(line.start_point.x() + self.pos_x, line.start_point.y() + self.pos_y)
-                end = QPointF(line.end_point.x() + self.pos_x, line.end_point.y() + self.pos_y)
-
-                # also apply the layer offset
-                offset = QPointF(self.current_layer.offset.x(), self.current_layer.offset.y())
-                start += offset
-                end += offset
-
-                # create a QPainterPath to hold the curve
-                path = QPainterPath()
-                path.moveTo(QPointF(start.x(), start.y()))
-
-                # calculate control points for the Bezier curve
-                dx = end.x() - start.x()
-                dy = end.y() - start.y()
-                ctrl1 = QPointF(start.x() + dx / 3, start.y() + dy / 3)
-                ctrl2 = QPointF(end.x() - dx / 3, end.y() - dy / 3)
-
-                # add the curve to the path
-                path.cubicTo(ctrl1, ctrl2, end)
-
-                # create a QPolygonF from the path to draw the curve
-                polygons = path.toSubpathPolygons()
-                if len(polygons) > 0:
-                    curve = QPolygonF(polygons[0])
-                    painter.drawPolyline(curve)
-        # convert to QImage and combine with self.current_layer.image
+            offset = QPoint(self.pos_x, self.pos_y) + self.current_layer.offset
+            box = self.visible_box(offset)
+            left, top, right, bottom = box
+
+            # finished strokes are drawn from the raster cache, only the
+            # stroke in progress is drawn as vectors
+            committed = len(layer.lines)
+            if self.is_drawing and layer is self.current_layer:
+                committed = min(committed, self.start_drawing_line_index)
+            layer.stroke_cache.refresh(layer.lines, committed)
+            self.draw_tiles(painter, layer.stroke_cache.image, offset, box)
+
+            # skip segments which are entirely off screen, including the pen width
+            boxes = layer.lines.boxes(slice(committed, None))
+            visible = np.flatnonzero(
+                (boxes[:, 2] >= left) & (boxes[:, 0] <= right) & (boxes[:, 3] >= top) & (boxes[:, 1] <= bottom)
+            )
+            draw_segments(painter, layer.lines, committed + visible, QPointF(offset))
 
     def draw_selection_box(self, painter):
         if self.select_start is not None and self.select_end is not None:
@@ -620,7 +1123,7 @@ class Canvas:
         self.update()
 
     def save_image(self, image_path):
-        image = self.current_layer.image.image
+        image = self.current_layer.flattened_image().image
         image = image.convert("RGBA")
         image.save(image_path)
         self.saving = False
@@ -634,37 +1137,106 @@ class Canvas:
     def recenter(self):
         self.pos_x = 0
         self.pos_y = 0
+        self.zoom = 1.0
         self.update()
 
+    def event_pos(self, event):
+        """
+        Return the position of a mouse event in unzoomed coordinates.
+        """
+        pos = event.pos()
+        return QPoint(int(pos.x() / self.zoom), int(pos.y() / self.zoom))
+
+    def set_zoom(self, zoom, anchor: QPoint = None):
+        """
+        Zoom the canvas keeping the canvas point under anchor (a widget
+        position) in place.
+        """
+        zoom = min(max(zoom, self.min_zoom), self.max_zoom)
+        if anchor is None:
+            anchor = self.canvas_container.rect().center()
+        # canvas point under the anchor before zooming
+        canvas_x = anchor.x() / self.zoom - self.pos_x
+        canvas_y = anchor.y() / self.zoom - self.pos_y
+        self.zoom = zoom
+        self.pos_x = int(round(anchor.x() / self.zoom - canvas_x))
+        self.pos_y = int(round(anchor.y() / self.zoom - canvas_y))
+        self.update()
+
+    def zoom_in(self, anchor: QPoint = None):
+        self.set_zoom(self.zoom * self.zoom_step, anchor)
+
+    def zoom_out(self, anchor: QPoint = None):
+        self.set_zoom(self.zoom / self.zoom_step, anchor)
+
+    def wheel_event(self, event):
+        # shift and control + scroll resize the working area, let the window handle those
+        if event.modifiers() & (Qt.KeyboardModifier.ShiftModifier | Qt.KeyboardModifier.ControlModifier):
+            event.ignore()
+            return
+        delta = event.angleDelta().y()
+        anchor = event.position().toPoint()
+        if delta > 0:
+            self.zoom_in(anchor)
+        elif delta < 0:
+            self.zoom_out(anchor)
+        event.accept()
+
+    def erase_history_event(self):
+        """
+        Return the history event of the current eraser stroke, adding it to
+        the history on the first change of the stroke.
+        """
+        if not self.is_erasing:
+            self.is_erasing = True
+            self.erase_event = {
+                "event": "erase",
+                "layer_index": self.current_layer_index
+            }
+            self.parent.history.add_event(self.erase_event)
+        return self.erase_event
+
     def handle_erase(self, event):
         # Erase any line segments that intersect with the current position of the mouse
         brush_size = self.settings_manager.settings.mask_brush_size.get()
-        start = event.pos() - QPoint(self.pos_x, self.pos_y) - self.image_pivot_point
-        for i, line in enumerate(self.current_layer.lines):
-            # check if line intersects with start using brush size radius
-            if line.intersects(start, brush_size):
-                if not self.is_erasing:
-                    self.is_erasing = True
-                    self.parent.history.add_event({
-                        "event": "erase",
-                        "layer_index": self.current_layer_index,
-                        "lines": self.current_layer.lines.copy()
-                    })
-                self.current_layer.lines.pop(i)
-                self.update()
-
-        # erase pixels from image
+        start = self.event_pos(event) - QPoint(self.pos_x, self.pos_y) - self.image_pivot_point
+        lines = self.current_layer.lines
+        # check if line intersects with start using brush size radius
+        erased = lines.near(start.x(), start.y(), brush_size)
+        if len(erased):
+            history_event = self.erase_history_event()
+            if "lines" not in history_event:
+                history_event["lines"] = lines.copy()
+            # only the tiles under the erased lines are rasterized again
+            stroke_cache = self.current_layer.stroke_cache
+            boxes = lines.boxes(erased)
+            for box in boxes.tolist():
+                stroke_cache.invalidate_box(box)
+            stroke_cache.line_count -= int(np.count_nonzero(erased < stroke_cache.line_count))
+            lines.remove(erased)
+            self.update_box((*boxes[:, :2].min(axis=0).tolist(), *boxes[:, 2:].max(axis=0).tolist()))
+
+        # erase pixels from image, only the tiles under the brush are touched
         if len(self.current_layer.images) > 0:
-            image = self.current_layer.images[0].image
-            if image:
-                image = image.copy()
-                draw = ImageDraw.Draw(image)
-                draw.ellipse((start.x() - brush_size, start.y() - brush_size, start.x() + brush_size, start.y() + brush_size), fill=(0, 0, 0, 0))
-                self.current_layer.images[0].image = image
-                self.update()
-
-
-        self.update()
+            image_data = self.current_layer.images[0]
+            center = start + image_data.position
+            box = (
+                center.x() - brush_size,
+                center.y() - brush_size,
+                center.x() + brush_size,
+                center.y() + brush_size
+            )
+            keys = image_data.tiles.stored_keys_in_box((box[0], box[1], box[2] + 1, box[3] + 1))
+            if keys:
+                # the tiles are kept for undo the first time the stroke touches them
+                history_event = self.erase_history_event()
+                if history_event.get("image_data") is not image_data:
+                    history_event["image_data"] = image_data
+                    history_event["tiles"] = {}
+                snapshot = history_event["tiles"]
+                snapshot.update(image_data.tiles.snapshot([key for key in keys if key not in snapshot]))
+                image_data.tiles.erase_ellipse(box)
+                self.update_box(box)
 
     def copy_image(self):
         im = self.current_active_image
@@ -744,29 +1316,28 @@ class Canvas:
             self.settings_manager.settings.mask_brush_size.get()
         )
 
+    def pen_id(self, event, lines: StrokeStore):
+        pen = self.pen(event)
+        return lines.intern_pen(pen.color().rgba(), pen.width(), pen.style().value)
+
     def handle_draw(self, event):
         # Continue drawing the current line as the mouse is moved but use brush_size
         # to control the radius of the line being drawn
-        start = event.pos() - QPoint(self.pos_x, self.pos_y)
-        pen = self.pen(event)
-        if len(self.current_layer.lines) > 0:
-            previous = LineData(self.current_layer.lines[-1].start_point, start, pen, self.current_layer_index)
-            self.current_layer.lines[-1] = previous
-        end = event.pos() - QPoint(self.pos_x, self.pos_y)
-        line_data = LineData(start, end, pen, self.current_layer_index)
-        self.current_layer.lines.append(line_data)
+        start = self.event_pos(event) - QPoint(self.pos_x, self.pos_y)
+        lines = self.current_layer.lines
+        lines.extend_stroke(start.x(), start.y(), self.pen_id(event, lines))
         self.update()
 
     def handle_move_canvas(self, event):
-        self.pos_x += event.pos().x() - self.drag_pos.x()
-        self.pos_y += event.pos().y() - self.drag_pos.y()
-        self.drag_pos = event.pos()
+        self.pos_x += self.event_pos(event).x() - self.drag_pos.x()
+        self.pos_y += self.event_pos(event).y() - self.drag_pos.y()
+        self.drag_pos = self.event_pos(event)
         self.update()
 
     def handle_move_layer(self, event):
         point = QPoint(
-            event.pos().x() if self.drag_pos is not None else 0,
-            event.pos().y() if self.drag_pos is not None else 0
+            self.event_pos(event).x() if self.drag_pos is not None else 0,
+            self.event_pos(event).y() if self.drag_pos is not None else 0
         )
         # snap to grid
         grid_size = self.settings_manager.settings.size.get()
@@ -780,11 +1351,12 @@ class Canvas:
         # establish a rect based on line points - we need the area that is being moved
         # so that we can center the point on it
         rect = QRect()
-        for line in self.current_layer.lines:
-            rect = rect.united(QRect(line.start_point, line.end_point))
+        bounds = self.current_layer.lines.bounds()
+        if bounds is not None:
+            rect = QRect(QPoint(bounds[0], bounds[1]), QPoint(bounds[2], bounds[3]))
 
         try:
-            rect = rect.united(QRect(self.current_layer.images[0].position.x(), self.current_layer.images[0].position.y(), self.current_layer.images[0].image.size[0], self.current_layer.images[0].image.size[1]))
+            rect = rect.united(QRect(self.current_layer.images[0].position.x(), self.current_layer.images[0].position.y(), self.current_layer.images[0].width, self.current_layer.images[0].height))
         except IndexError:
             pass
 
@@ -793,40 +1365,38 @@ class Canvas:
         point.setY(int(point.y() - int(rect.height() / 2)))
 
         self.layers[self.current_layer_index].offset = point
+        self.update()
 
     def mouse_press_event(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
-            self.select_start = event.pos()
+            self.select_start = self.event_pos(event)
         if event.button() in (Qt.MouseButton.LeftButton, Qt.MouseButton.RightButton):
             if self.brush_selected:
                 self.start_drawing_line_index = len(self.current_layer.lines)
-                start = event.pos() - QPoint(self.pos_x, self.pos_y)
-                end = event.pos() - QPoint(self.pos_x, self.pos_y)
-                pen = self.pen(event)
-                line = LineData(start, end, pen, self.current_layer_index)
-                start += self.layers[self.current_layer_index].offset
-                end += self.layers[self.current_layer_index].offset
-                self.current_layer.lines += [line]
+                start = self.event_pos(event) - QPoint(self.pos_x, self.pos_y)
+                lines = self.current_layer.lines
+                self.is_drawing = True
+                lines.begin_stroke(start.x(), start.y(), self.pen_id(event, lines))
             self.handle_tool(event)
             self.update()
         elif event.button() == Qt.MouseButton.MiddleButton:
             # Start dragging the canvas when the middle or right mouse button is pressed
-            self.drag_pos = event.pos()
+            self.drag_pos = self.event_pos(event)
 
     def mouse_move_event(self, event):
         # check if LeftButton is pressed
         if Qt.MouseButton.LeftButton in event.buttons() or Qt.MouseButton.RightButton in event.buttons():
+            # every tool requests its own repaint, the eraser only repaints what it touched
             self.handle_tool(event)
-            self.update()
         elif self.drag_pos is not None:
             self.handle_move_canvas(event)
 
     def handle_select(self, event):
         if self.select_selected:
             if self.select_start is None:
-                self.select_start = event.pos()
+                self.select_start = self.event_pos(event)
             else:
-                self.select_end = event.pos()
+                self.select_end = self.event_pos(event)
 
         # snap to grid if enabled
         if self.settings_manager.settings.snap_to_grid.get():
@@ -854,7 +1424,7 @@ class Canvas:
             self.handle_move_active_grid_area(event)
 
     def handle_move_active_grid_area(self, event):
-        pos = event.pos()
+        pos = self.event_pos(event)
         point = QPoint(
             pos.x(),
             pos.y()
@@ -882,6 +1452,8 @@ class Canvas:
     def mouse_release_event(self, event):
         if event.button() in (Qt.MouseButton.LeftButton, Qt.MouseButton.RightButton):
             if self.brush_selected:
+                # the finished stroke is rasterized into the stroke cache on the next paint
+                self.is_drawing = False
                 self.stop_drawing_line_index = len(self.current_layer.lines)
                 self.parent.history.add_event({
                     "event": "draw",
@@ -891,7 +1463,8 @@ class Canvas:
                 })
                 self.update()
             elif self.eraser_selected:
-                is_erasing = False
+                # the next eraser stroke starts a new history event
+                self.is_erasing = False
         elif event.button() == Qt.MouseButton.MiddleButton:
             # Start dragging the canvas when the middle or right mouse button is pressed
-            self.drag_pos = event.pos()
+            self.drag_pos = self.event_pos(event)
@@ -0,0 +1,115 @@
+import time
+from PyQt6.QtCore import QTimer, QRect
+from PyQt6.QtGui import QRegion
+
+# upper bounds, in milliseconds, of the frame time histogram buckets
+FRAME_TIME_BUCKETS = (4, 8, 16, 33, 66, 133)
+
+
+class RepaintScheduler:
+    """
+    Paces the repaints of a widget to at most one per display frame.
+
+    Repaint requests made before the next frame are merged into a single
+    dirty region. Deferred callbacks (slider values, filter previews) are
+    keyed, only the last one queued for a key runs, right before the
+    repaint, so intermediate values are dropped.
+    """
+    def __init__(self, widget, frame_interval=None):
+        self.widget = widget
+        if frame_interval is None:
+            screen = widget.screen()
+            refresh_rate = screen.refreshRate() if screen else 0
+            frame_interval = 1000.0 / refresh_rate if refresh_rate > 0 else 1000.0 / 60
+        self.frame_interval = frame_interval
+        self.region = QRegion()
+        self.full = False
+        self.deferred = {}
+        self.last_flush = 0.0
+        self.requests = 0
+        self.repaints = 0
+        self.frame_times = [0] * (len(FRAME_TIME_BUCKETS) + 1)
+        self._paint_start = None
+        self.timer = QTimer(widget)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    @property
+    def pending(self):
+        return self.timer.isActive()
+
+    def request(self, rect: QRect = None):
+        """
+        Ask for a repaint of rect, or of the whole widget when rect is None.
+        """
+        self.requests += 1
+        if rect is None:
+            self.full = True
+        elif not self.full:
+            self.region = self.region.united(rect)
+        self.schedule()
+
+    def defer(self, key, callback):
+        """
+        Run callback before the next repaint, replacing any callback already
+        waiting under the same key.
+        """
+        self.deferred[key] = callback
+        self.request()
+
+    def discard(self, key):
+        """
+        Drop the callback waiting under key, if any.
+        """
+        self.deferred.pop(key, None)
+
+    def schedule(self):
+        if self.pending:
+            return
+        elapsed = (time.perf_counter() - self.last_flush) * 1000
+        self.timer.start(max(0, int(self.frame_interval - elapsed)))
+
+    def flush(self):
+        """
+        Run the deferred callbacks and repaint the dirty region now.
+        """
+        self.timer.stop()
+        deferred = self.deferred
+        self.deferred = {}
+        for callback in deferred.values():
+            callback()
+        if self.full:
+            self.widget.update()
+        elif not self.region.isEmpty():
+            self.widget.update(self.region)
+        self.full = False
+        self.region = QRegion()
+        self.last_flush = time.perf_counter()
+        self.repaints += 1
+
+    def paint_started(self):
+        self._paint_start = time.perf_counter()
+
+    def paint_finished(self):
+        if self._paint_start is None:
+            return
+        elapsed = (time.perf_counter() - self._paint_start) * 1000
+        self._paint_start = None
+        for index, bound in enumerate(FRAME_TIME_BUCKETS):
+            if elapsed < bound:
+                break
+        else:
+            index = len(FRAME_TIME_BUCKETS)
+        self.frame_times[index] += 1
+
+    def frame_time_histogram(self):
+        """
+        Return {bucket label: number of paints} of the time spent in paint
+        events, along with the number of repaint requests and repaints.
+        """
+        labels = [f"<{bound}ms" for bound in FRAME_TIME_BUCKETS] + [f">={FRAME_TIME_BUCKETS[-1]}ms"]
+        return {
+            "frame_times": dict(zip(labels, self.frame_times)),
+            "requests": self.requests,
+            "repaints": self.repaints,
+        }
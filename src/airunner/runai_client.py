@@ -1,12 +1,15 @@
 import json
 import queue
-import time
 from PyQt6 import QtCore
 from PyQt6.QtCore import QThread
 from aihandler.qtvar import BooleanVar
 from aihandler.runner import SDRunner
+from jobs import Job, JobQueue, INTERACTIVE, request_key
 import logging
 
+# put on a worker queue to make the worker return
+STOP = object()
+
 
 class OfflineClient(QtCore.QObject):
     sd_runner = None
@@ -36,8 +39,26 @@ class OfflineClient(QtCore.QObject):
             self.logger.info("cancel message recieved")
             self.cancel()
         else:
-            self.logger.info("Putting message in queue")
-            self.queue.put(msg)
+            self.submit(msg)
+
+    def submit(self, data, priority=INTERACTIVE, key=None, supersede=True):
+        """
+        Queue a request and return its job id. A pending request with the
+        same key (request_key(data) by default) is superseded by this one.
+        :param priority: INTERACTIVE or BATCH, lower values run first
+        :param supersede: False to queue the request next to pending ones
+        """
+        if supersede and key is None:
+            key = request_key(data)
+        job = Job(data, priority, key if supersede else None)
+        if isinstance(data, dict):
+            # the runner sends results with the data of their request
+            data["job_id"] = job.id
+        self.logger.info("Putting message in queue")
+        superseded = self.queue.put(job)
+        if superseded is not None:
+            self.logger.info(f"Job {superseded.id} superseded by job {job.id}")
+        return job.id
 
     @property
     def response(self):
@@ -56,15 +77,60 @@ class OfflineClient(QtCore.QObject):
         """
         self.res_queue.put(msg)
 
-    def cancel(self):
-        self.sd_runner.cancel()
+    def cancel(self, job_id=None):
+        """
+        Cancel a job, the running job by default. Queued jobs are dropped
+        before they start, results of a cancelled running job are dropped by
+        wants_result.
+        :return: True if the job was queued or running
+        """
+        with self.queue.condition:
+            running = self.queue.running
+            if job_id is None or (running is not None and running.id == job_id):
+                if running is not None:
+                    running.cancelled = True
+                    self.cancelled_jobs.add(running.id)
+                self.sd_runner.cancel()
+                return running is not None
+            return self.queue.cancel(job_id)
+
+    def wants_result(self, data):
+        """
+        False for results of a job which was cancelled while it ran.
+        """
+        return not isinstance(data, dict) or data.get("job_id") not in self.cancelled_jobs
+
+    def cancel_pending(self):
+        """
+        Drop every queued job, the running job is not affected.
+        :return: ids of the dropped jobs
+        """
+        return self.queue.clear()
+
+    def queue_depth(self, priority=None):
+        return self.queue.depth(priority)
+
+    def pending_jobs(self):
+        """
+        (job id, priority) of the queued jobs in the order they will run.
+        """
+        return self.queue.pending()
+
+    def run_job(self, job):
+        try:
+            # the job may have been cancelled after the worker took it
+            if not job.cancelled:
+                self.callback(job.data)
+        finally:
+            self.queue.finish(job)
 
     def __init__(self, **kwargs):
         super().__init__(
             parent=kwargs.get("parent", None)
         )
         self.quit_event = BooleanVar()
-        self.queue = queue.Queue()
+        self.queue = JobQueue()
+        self.cancelled_jobs = set()
         self.res_queue = queue.Queue()
         self.quit_event.set(False)
         self.logger = logging.getLogger()
@@ -110,7 +176,28 @@ class OfflineClient(QtCore.QObject):
     def handle_error(self, error):
         self.logger.error(error)
 
+    def prepare(self, data):
+        """
+        Run the preprocessing of a request on the request thread. Requests
+        may carry a "prepare" option, a callable returning more options
+        (such as the input image and mask).
+        :param data:
+        :return: False if the request could not be prepared
+        """
+        prepare = data.get("options", {}).pop("prepare", None)
+        if prepare is None:
+            return True
+        try:
+            data["options"].update(prepare())
+        except Exception as e:
+            self.logger.error(f"Failed to prepare request: {e}")
+            self.error_var.set(str(e))
+            return False
+        return True
+
     def callback(self, data):
+        if not self.prepare(data):
+            return
         action = data.get("action")
         model = None
         model = data["options"][f"{data['action']}_model"]
@@ -143,43 +230,72 @@ class OfflineClient(QtCore.QObject):
     def create_worker_thread(self):
         # start worker in a new thread using the self.worker method
         self.response_worker = ResponseWorker(client=self)
-        self.request_worker = RequestWorker(client=self, callback=self.callback)
+        self.request_worker = RequestWorker(client=self, callback=self.run_job)
         self.response_worker_thread = QThread()
-        self.response_worker_thread.started.connect(self.response_worker.startWork)
         self.request_worker_thread = QThread()
-        self.request_worker_thread.started.connect(self.request_worker.startWork)
-        self.response_worker_thread.start()
-        self.request_worker_thread.start()
+        # move the workers before starting so startWork runs on the worker threads
         self.response_worker.moveToThread(self.response_worker_thread)
         self.request_worker.moveToThread(self.request_worker_thread)
+        self.response_worker_thread.started.connect(self.response_worker.startWork)
+        self.request_worker_thread.started.connect(self.request_worker.startWork)
         self.response_worker.signalStatus.connect(self.request_signal_status)
         self.request_worker.signalStatus.connect(self.response_signal_status)
+        self.response_worker_thread.start()
+        self.request_worker_thread.start()
 
-    def force_request_worker_reset(self):
-        if self.request_worker_thread and self.request_worker_thread.isRunning():
-            print('Terminating thread.')
-            self.request_worker_thread.terminate()
-
-            print('Waiting for thread termination.')
-            self.request_worker_thread.wait()
-
-            self.request_signal_status.emit('Idle.')
-
-        if self.response_worker_thread and self.response_worker_thread.isRunning():
-            print('Terminating thread.')
-            self.response_worker_thread.terminate()
-
-            print('Waiting for thread termination.')
-            self.response_worker_thread.wait()
-
-            self.response_signal_status.emit('Idle.')
+    def stop_worker(self, worker_thread, worker_queue, status_signal):
+        """
+        Stop a worker after the message it is handling and wait for its
+        thread to finish.
+        :return: the messages which were still queued
+        """
+        pending = []
+        while True:
+            try:
+                pending.append(worker_queue.get_nowait())
+            except queue.Empty:
+                break
+        if worker_thread is None or not worker_thread.isRunning():
+            return pending
+        worker_queue.put(STOP)
+        worker_thread.quit()
+        worker_thread.wait()
+        status_signal.emit('Idle.')
+        return pending
+
+    def stop_workers(self):
+        """
+        Cancel the running request and stop both workers, used on exit.
+        """
+        if self.sd_runner is not None:
+            self.sd_runner.cancel()
+        self.stop_worker(self.request_worker_thread, self.queue, self.request_signal_status)
+        self.stop_worker(self.response_worker_thread, self.res_queue, self.response_signal_status)
 
+    def force_request_worker_reset(self):
+        """
+        Cancel the running request and restart both workers, queued messages
+        are handed to the new workers.
+        """
+        if self.sd_runner is not None:
+            self.sd_runner.cancel()
+        requests = self.stop_worker(self.request_worker_thread, self.queue, self.request_signal_status)
+        responses = self.stop_worker(self.response_worker_thread, self.res_queue, self.response_signal_status)
         self.create_worker_thread()
+        for msg in requests:
+            self.queue.put(msg)
+        for msg in responses:
+            self.res_queue.put(msg)
 
     def force_request_worker_quit(self):
-        if self.request_worker_thread.isRunning():
-            self.request_worker_thread.terminate()
-            self.request_worker_thread.wait()
+        """
+        Cancel the running request and stop the request worker. Queued
+        requests stay in the queue for the next worker.
+        """
+        if self.sd_runner is not None:
+            self.sd_runner.cancel()
+        for msg in self.stop_worker(self.request_worker_thread, self.queue, self.request_signal_status):
+            self.queue.put(msg)
 
 
 class RequestWorker(QtCore.QObject):
@@ -193,19 +309,17 @@ class RequestWorker(QtCore.QObject):
 
     @QtCore.pyqtSlot()
     def startWork(self):
+        # blocks until a message arrives, so an idle worker uses no cpu
         while True:
-            # check if we are connected to server
-            if not self.client.queue.empty():
-                try:
-                    msg = self.client.queue.get(timeout=1)
-                except queue.Empty:
-                    msg = None
-                if msg == "quit":
-                    # self.parent.quit_event.set(True)
-                    # break
-                    pass
-                self.callback(msg)
-            time.sleep(0.01)
+            job = self.client.queue.get()
+            if job is STOP:
+                break
+            if job.data == "quit":
+                continue
+            try:
+                self.callback(job)
+            except Exception as e:
+                self.client.logger.error(f"Request failed: {e}")
 
 
 class ResponseWorker(QtCore.QObject):
@@ -219,9 +333,8 @@ class ResponseWorker(QtCore.QObject):
     @QtCore.pyqtSlot()
     def startWork(self):
         while True:
-            try:
-                msg = self.client.res_queue.get(timeout=1)
-            except queue.Empty:
-                msg = None
+            msg = self.client.res_queue.get()
+            if msg is STOP:
+                break
             if msg != "" and msg is not None:
                 self.client.handle_response(msg)
@@ -0,0 +1,443 @@
+import itertools
+import cv2
+import numpy as np
+
+CELL_SIZE = 64
+
+# versions are shared by every store so a version identifies the content of one store
+_versions = itertools.count(1)
+
+
+class SegmentIndex:
+    """
+    Uniform grid over segment boxes. Every cell maps to the set of ids of
+    the segments whose (unpadded) box touches it, empty cells are not stored.
+    """
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _entries(self, segments):
+        """
+        Return the (cell x, cell y, row) of every cell each segment touches.
+        """
+        size = self.cell_size
+        first_x = np.minimum(segments[:, 0], segments[:, 2]) // size
+        first_y = np.minimum(segments[:, 1], segments[:, 3]) // size
+        span_x = np.maximum(segments[:, 0], segments[:, 2]) // size - first_x
+        span_y = np.maximum(segments[:, 1], segments[:, 3]) // size - first_y
+        rows = np.arange(len(segments))
+        entries = []
+        # segments rarely span more than a couple of cells
+        for dy in range(int(span_y.max(initial=-1)) + 1):
+            for dx in range(int(span_x.max(initial=-1)) + 1):
+                mask = (span_x >= dx) & (span_y >= dy)
+                entries.append((first_x[mask] + dx, first_y[mask] + dy, rows[mask]))
+        if not entries:
+            return [], [], []
+        return (np.concatenate([entry[i] for entry in entries]).tolist() for i in range(3))
+
+    def add(self, ids, segments):
+        cells = self.cells
+        ids = ids.tolist()
+        for cell_x, cell_y, row in zip(*self._entries(segments)):
+            cell = cells.get((cell_x, cell_y))
+            if cell is None:
+                cell = cells[(cell_x, cell_y)] = set()
+            cell.add(ids[row])
+
+    def remove(self, ids, segments):
+        cells = self.cells
+        ids = ids.tolist()
+        for cell_x, cell_y, row in zip(*self._entries(segments)):
+            cell = cells.get((cell_x, cell_y))
+            if cell is None:
+                continue
+            cell.discard(ids[row])
+            if not cell:
+                del cells[(cell_x, cell_y)]
+
+    def query(self, box):
+        """
+        Return the ids of the segments in the cells touching a (left, top,
+        right, bottom) box, walking whichever of the box or the stored cells
+        is smaller.
+        """
+        left, top, right, bottom = box
+        if right <= left or bottom <= top:
+            return set()
+        size = self.cell_size
+        first_x, first_y = left // size, top // size
+        last_x, last_y = (right - 1) // size, (bottom - 1) // size
+        result = set()
+        if (last_x - first_x + 1) * (last_y - first_y + 1) <= len(self.cells):
+            for cell_y in range(first_y, last_y + 1):
+                for cell_x in range(first_x, last_x + 1):
+                    cell = self.cells.get((cell_x, cell_y))
+                    if cell:
+                        result |= cell
+        else:
+            for (cell_x, cell_y), cell in self.cells.items():
+                if first_x <= cell_x <= last_x and first_y <= cell_y <= last_y:
+                    result |= cell
+        return result
+
+    def edge_cells(self):
+        """
+        Return the ids in the leftmost, topmost, rightmost and bottommost
+        occupied columns and rows of cells.
+        """
+        keys = self.cells.keys()
+        left = min(key[0] for key in keys)
+        top = min(key[1] for key in keys)
+        right = max(key[0] for key in keys)
+        bottom = max(key[1] for key in keys)
+        edges = (set(), set(), set(), set())
+        for (cell_x, cell_y), cell in self.cells.items():
+            if cell_x == left:
+                edges[0].update(cell)
+            if cell_y == top:
+                edges[1].update(cell)
+            if cell_x == right:
+                edges[2].update(cell)
+            if cell_y == bottom:
+                edges[3].update(cell)
+        return edges
+
+
+class StrokeStore:
+    """
+    Columnar storage for the brush segments of a layer.
+
+    Every segment is a row of (x0, y0, x1, y1) in segments and an index into
+    the pen table in pen_ids. Pens are interned (rgba, width, style) tuples.
+    stroke_offsets holds the index of the first segment of every stroke.
+
+    Every segment also gets an id which never changes while it is in the
+    store. Ids are handed out in increasing order and removal keeps the
+    order, so ids stays sorted and an id is found with a binary search. The
+    spatial index works on ids and is kept up to date as segments are added
+    and removed, it is built the first time it is queried.
+
+    version changes whenever segments are added, changed or removed.
+
+    The store behaves enough like a list of segments for history bookkeeping:
+    len(), slicing, del with a slice, copy() and extend().
+    """
+    def __init__(self):
+        self._segments = np.zeros((16, 4), dtype=np.int32)
+        self._pen_ids = np.zeros(16, dtype=np.uint16)
+        self._ids = np.zeros(16, dtype=np.int64)
+        self._next_id = 0
+        self._index = None
+        self._bounds = None
+        self.count = 0
+        self.stroke_offsets = np.zeros(0, dtype=np.int64)
+        self.pens = []
+        self._pen_lookup = {}
+        self._pen_widths = np.zeros(0, dtype=np.int32)
+        self.version = next(_versions)
+
+    @property
+    def segments(self):
+        return self._segments[:self.count]
+
+    @property
+    def pen_ids(self):
+        return self._pen_ids[:self.count]
+
+    @property
+    def ids(self):
+        return self._ids[:self.count]
+
+    @property
+    def spatial_index(self):
+        if self._index is None:
+            self._index = SegmentIndex()
+            self._index.add(self.ids, self.segments)
+        return self._index
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return {
+            "segments": self.segments.copy(),
+            "pen_ids": self.pen_ids.copy(),
+            "stroke_offsets": self.stroke_offsets,
+            "pens": self.pens,
+        }
+
+    def __setstate__(self, state):
+        self.__init__()
+        for pen in state["pens"]:
+            self.intern_pen(*pen)
+        self._append_rows(state["segments"].astype(np.int32).reshape(-1, 4), state["pen_ids"])
+        self.stroke_offsets = state["stroke_offsets"]
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError("StrokeStore only supports slicing")
+        start, stop, _ = item.indices(self.count)
+        stop = max(start, stop)
+        store = StrokeStore()
+        store.pens = list(self.pens)
+        store._pen_lookup = dict(self._pen_lookup)
+        store._pen_widths = self._pen_widths.copy()
+        store._append_rows(self._segments[start:stop], self._pen_ids[start:stop])
+        offsets = self.stroke_offsets[(self.stroke_offsets >= start) & (self.stroke_offsets < stop)] - start
+        if stop > start:
+            offsets = np.union1d([0], offsets)
+        store.stroke_offsets = offsets.astype(np.int64)
+        return store
+
+    def __delitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError("StrokeStore only supports slicing")
+        start, stop, _ = item.indices(self.count)
+        keep = np.ones(self.count, dtype=bool)
+        keep[start:stop] = False
+        self._keep(keep)
+
+    def copy(self):
+        return self[:]
+
+    def intern_pen(self, rgba, width, style):
+        """
+        Return the index of a pen in the pen table, adding it if needed.
+        """
+        key = (int(rgba), int(width), int(style))
+        index = self._pen_lookup.get(key)
+        if index is None:
+            index = len(self.pens)
+            self.pens.append(key)
+            self._pen_lookup[key] = index
+            self._pen_widths = np.append(self._pen_widths, key[1]).astype(np.int32)
+        return index
+
+    def _reserve(self, n):
+        needed = self.count + n
+        if needed <= len(self._segments):
+            return
+        # grow geometrically so that appending a segment per mouse event is cheap
+        capacity = max(needed, len(self._segments) * 2)
+        segments = np.zeros((capacity, 4), dtype=np.int32)
+        segments[:self.count] = self.segments
+        pen_ids = np.zeros(capacity, dtype=np.uint16)
+        pen_ids[:self.count] = self.pen_ids
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self.count] = self.ids
+        self._segments = segments
+        self._pen_ids = pen_ids
+        self._ids = ids
+
+    def _append_rows(self, segments, pen_ids, ids=None):
+        n = len(segments)
+        self._reserve(n)
+        if ids is None:
+            ids = np.arange(self._next_id, self._next_id + n, dtype=np.int64)
+            self._next_id += n
+        self._segments[self.count:self.count + n] = segments
+        self._pen_ids[self.count:self.count + n] = pen_ids
+        self._ids[self.count:self.count + n] = ids
+        self.count += n
+        if n:
+            self.version = next(_versions)
+        if self._index is not None and n:
+            self._index.add(ids, self.segments[-n:])
+        if self._bounds is not None and n:
+            self._grow_bounds(self.segments[-n:])
+
+    def begin_stroke(self, x, y, pen_id):
+        """
+        Start a new stroke with a single point segment.
+        """
+        self.stroke_offsets = np.append(self.stroke_offsets, self.count)
+        self._append_rows(np.array([[x, y, x, y]], dtype=np.int32), [pen_id])
+
+    def extend_stroke(self, x, y, pen_id):
+        """
+        Continue the current stroke to x, y. The last segment is ended at the
+        new point and a single point segment is added after it.
+        """
+        if self.count > 0:
+            last = slice(self.count - 1, self.count)
+            if self._index is not None:
+                self._index.remove(self._ids[last], self._segments[last])
+            self._segments[self.count - 1, 2:] = (x, y)
+            self._pen_ids[self.count - 1] = pen_id
+            if self._index is not None:
+                self._index.add(self._ids[last], self._segments[last])
+            if self._bounds is not None:
+                self._grow_bounds(self._segments[last])
+        self._append_rows(np.array([[x, y, x, y]], dtype=np.int32), [pen_id])
+
+    def extend(self, other):
+        """
+        Append all segments of another store.
+        """
+        if len(other) == 0:
+            return
+        remap = np.array([self.intern_pen(*pen) for pen in other.pens], dtype=np.uint16)
+        offsets = other.stroke_offsets + self.count
+        self._append_rows(other.segments, remap[other.pen_ids])
+        self.stroke_offsets = np.union1d(self.stroke_offsets, offsets).astype(np.int64)
+
+    def remove(self, indices):
+        """
+        Remove segments by index, the strokes they were part of are split.
+        """
+        keep = np.ones(self.count, dtype=bool)
+        keep[indices] = False
+        self._keep(keep)
+
+    def _keep(self, keep):
+        removed = np.flatnonzero(~keep)
+        if len(removed) == 0:
+            return
+        kept_before = np.concatenate(([0], np.cumsum(keep)))
+        # the segment after a removed one starts a new stroke
+        offsets = np.concatenate((self.stroke_offsets, removed + 1))
+        offsets = offsets[offsets < self.count]
+        if self._index is not None:
+            self._index.remove(self.ids[removed], self.segments[removed])
+        if self._bounds is not None:
+            # the bounds only shrink when a removed segment lies on them
+            segments = self.segments[removed]
+            left, top, right, bottom = self._bounds
+            if (segments[:, 0::2].min() <= left or segments[:, 1::2].min() <= top
+                    or segments[:, 0::2].max() >= right or segments[:, 1::2].max() >= bottom):
+                self._bounds = None
+        segments = self.segments[keep]
+        pen_ids = self.pen_ids[keep]
+        ids = self.ids[keep]
+        # the kept segments are already in the index and the bounds
+        index, self._index = self._index, None
+        bounds, self._bounds = self._bounds, None
+        self.count = 0
+        self._append_rows(segments, pen_ids, ids)
+        self._index = index
+        self._bounds = bounds
+        self.version = next(_versions)
+        offsets = np.unique(kept_before[offsets])
+        self.stroke_offsets = offsets[offsets < self.count].astype(np.int64)
+
+    def strokes(self, start=0, end=None):
+        """
+        Yield (first, last) segment index ranges of the strokes between start
+        and end.
+        """
+        end = self.count if end is None else end
+        bounds = self.stroke_offsets[(self.stroke_offsets > start) & (self.stroke_offsets < end)]
+        edges = np.concatenate(([start], bounds, [end])) if end > start else []
+        for first, last in zip(edges[:-1], edges[1:]):
+            yield int(first), int(last)
+
+    def boxes(self, index=slice(None)):
+        """
+        Return the (left, top, right, bottom) boxes of the segments selected
+        by index (a slice or an index array) including the pen width, as an
+        (n, 4) array.
+        """
+        segments = self.segments[index]
+        if len(self.pens) == 0:
+            pad = np.full(len(segments), 2, dtype=np.int32)
+        else:
+            pad = self._pen_widths[self.pen_ids[index]] // 2 + 2
+        return np.stack((
+            np.minimum(segments[:, 0], segments[:, 2]) - pad,
+            np.minimum(segments[:, 1], segments[:, 3]) - pad,
+            np.maximum(segments[:, 0], segments[:, 2]) + pad,
+            np.maximum(segments[:, 1], segments[:, 3]) + pad,
+        ), axis=1)
+
+    def _rows(self, ids):
+        """
+        Return the sorted row indices of a collection of segment ids.
+        """
+        ids = np.fromiter(ids, dtype=np.int64, count=len(ids))
+        return np.sort(np.searchsorted(self.ids, ids))
+
+    def near(self, x, y, distance):
+        """
+        Return the indices of segments which start within distance of x, y.
+        Only the segments in the index cells around x, y are tested.
+        """
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int64)
+        candidates = self.spatial_index.query((x - distance + 1, y - distance + 1, x + distance, y + distance))
+        rows = self._rows(candidates)
+        segments = self.segments[rows]
+        return rows[
+            (np.abs(segments[:, 0] - x) < distance) & (np.abs(segments[:, 1] - y) < distance)
+        ]
+
+    def _grow_bounds(self, segments):
+        left, top, right, bottom = self._bounds
+        self._bounds = (
+            min(left, int(segments[:, 0::2].min())),
+            min(top, int(segments[:, 1::2].min())),
+            max(right, int(segments[:, 0::2].max())),
+            max(bottom, int(segments[:, 1::2].max())),
+        )
+
+    def bounds(self):
+        """
+        Return the (left, top, right, bottom) box of all segment end points or
+        None. The bounds grow as segments are added and are only looked up
+        again, from the outermost index cells, after a segment on them was
+        removed.
+        """
+        if self.count == 0:
+            return None
+        if self._bounds is None:
+            left, top, right, bottom = (self.segments[self._rows(ids)] for ids in self.spatial_index.edge_cells())
+            self._bounds = (
+                int(left[:, 0::2].min()),
+                int(top[:, 1::2].min()),
+                int(right[:, 0::2].max()),
+                int(bottom[:, 1::2].max()),
+            )
+        return self._bounds
+
+    @staticmethod
+    def from_lines(lines):
+        """
+        Build a store from LineData objects, used to load older documents.
+        """
+        store = StrokeStore()
+        for line in lines:
+            rgba, width, style = line.pen_key
+            pen_id = store.intern_pen(rgba, width, style)
+            store._append_rows(np.array([[
+                line.start_point.x(), line.start_point.y(), line.end_point.x(), line.end_point.y()
+            ]], dtype=np.int32), [pen_id])
+        # older documents do not record strokes, every connected run is one
+        segments = store.segments
+        if store.count:
+            breaks = np.flatnonzero(np.any(segments[1:, :2] != segments[:-1, 2:], axis=1)) + 1
+            store.stroke_offsets = np.concatenate(([0], breaks)).astype(np.int64)
+        return store
+
+
+def rasterize(strokes, array, indices=None, offset=(0, 0)):
+    """
+    Draw the segments of a StrokeStore at indices (all by default) into an
+    RGB or RGBA uint8 array in place, offset is added to the coordinates.
+    Consecutive segments with the same pen are drawn by a single
+    cv2.polylines call, so the number of calls grows with the pen changes
+    rather than with the segments. Colors are drawn without their alpha.
+    """
+    if indices is None:
+        indices = slice(None)
+    segments = strokes.segments[indices]
+    if len(segments) == 0:
+        return array
+    segments = (segments + np.array([offset[0], offset[1], offset[0], offset[1]], dtype=np.int32)).reshape(-1, 2, 2)
+    pen_ids = strokes.pen_ids[indices]
+    runs = np.concatenate(([0], np.flatnonzero(pen_ids[1:] != pen_ids[:-1]) + 1, [len(pen_ids)]))
+    for first, last in zip(runs[:-1], runs[1:]):
+        rgba, width, _style = strokes.pens[pen_ids[first]]
+        color = ((rgba >> 16) & 0xff, (rgba >> 8) & 0xff, rgba & 0xff)
+        cv2.polylines(array, segments[first:last], False, color, int(width))
+    return array
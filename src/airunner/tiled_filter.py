@@ -0,0 +1,113 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image
+from PIL.ImageFilter import GaussianBlur, BoxBlur, UnsharpMask
+
+# size of the blocks an image is split into, not counting the halo
+BLOCK_SIZE = 512
+
+# PIL releases the GIL while filtering so threads use every core
+WORKERS = os.cpu_count() or 1
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="filter")
+    return _executor
+
+
+def run_filter(image, image_filter):
+    """
+    Filter a PIL image. Filters implemented on PIL images provide
+    apply_image and are called with the image, PIL filters go through
+    Image.filter.
+    """
+    apply_image = getattr(image_filter, "apply_image", None)
+    if apply_image is not None:
+        return apply_image(image)
+    return image.filter(image_filter)
+
+
+def filter_halo(image_filter):
+    """
+    Return how many pixels around a block a filter reads to compute the
+    block, or None when the filter needs the whole image. Filters may
+    declare a halo attribute, point operations have a halo of 0.
+    """
+    if getattr(image_filter, "whole_image", False):
+        return None
+    halo = getattr(image_filter, "halo", None)
+    if halo is not None:
+        return halo
+    radius = getattr(image_filter, "radius", None)
+    if isinstance(radius, (tuple, list)):
+        radius = max(radius)
+    if isinstance(image_filter, BoxBlur):
+        return math.ceil(radius) + 1
+    if isinstance(image_filter, (GaussianBlur, UnsharpMask)):
+        # the gaussian is approximated with three box blurs of about radius each
+        return math.ceil(radius * 3) + 2
+    return None
+
+
+def apply_tiled(image, image_filter, progress=None, is_cancelled=None, block_size=BLOCK_SIZE):
+    """
+    Filter an image in blocks on the filter thread pool and stitch the
+    results. Every block is filtered together with a halo of its neighbours
+    so the seams match filtering the whole image at once.
+
+    :param progress: optional callable receiving (blocks done, blocks)
+    :param is_cancelled: optional callable, when it returns True the
+        remaining blocks are skipped and None is returned
+    """
+    halo = filter_halo(image_filter)
+    width, height = image.size
+    if halo is not None:
+        # keep the halo small next to the block, halo pixels are filtered by every block they border
+        block_size = max(block_size, halo * 8)
+    if halo is None or WORKERS == 1 or (width <= block_size and height <= block_size):
+        result = run_filter(image, image_filter)
+        if progress:
+            progress(1, 1)
+        return result
+
+    def run(box):
+        left, top, right, bottom = box
+        outer = (
+            max(0, left - halo),
+            max(0, top - halo),
+            min(width, right + halo),
+            min(height, bottom + halo)
+        )
+        filtered = run_filter(image.crop(outer), image_filter)
+        return filtered.crop((left - outer[0], top - outer[1], right - outer[0], bottom - outer[1]))
+
+    boxes = [
+        (x, y, min(width, x + block_size), min(height, y + block_size))
+        for y in range(0, height, block_size)
+        for x in range(0, width, block_size)
+    ]
+    futures = {executor().submit(run, box): box for box in boxes}
+    result = None
+    done_count = 0
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            if is_cancelled and is_cancelled():
+                return None
+            for future in done:
+                block = future.result()
+                if result is None:
+                    result = Image.new(block.mode, (width, height))
+                result.paste(block, futures[future][:2])
+                done_count += 1
+                if progress:
+                    progress(done_count, len(boxes))
+    finally:
+        for future in pending:
+            future.cancel()
+    return result
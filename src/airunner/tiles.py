@@ -0,0 +1,331 @@
+import itertools
+from PIL import Image, ImageDraw
+
+TILE_SIZE = 256
+
+# the coarsest level of the mip pyramid, a level n tile covers 2 ** n tiles
+# in each direction
+MAX_LEVEL = 5
+
+# versions are shared by every grid so that a tile keeps a unique version
+# even after the grid it lives in has been copied
+_versions = itertools.count(1)
+
+
+class TileGrid:
+    """
+    Sparse RGBA image storage.
+
+    Pixels are stored in square tiles keyed by tile coordinate, tiles which are
+    fully transparent are not stored. Coordinates are canvas coordinates, they
+    may be negative. Tiles are shared between copies of a grid and are copied
+    the first time they are written to.
+    """
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.tiles = {}
+        self.versions = {}
+        self.version = 0
+        self._owned = set()
+        self._levels = {}
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_owned"] = set()
+        state["_levels"] = {}
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("_levels", {})
+        self.__dict__.update(state)
+        # versions restart in every process, the loaded ones may already be in use
+        self.touch()
+
+    def copy(self):
+        """
+        Return a copy of the grid which shares all tiles with this grid.
+        """
+        grid = TileGrid(self.tile_size)
+        grid.tiles = self.tiles.copy()
+        grid.versions = self.versions.copy()
+        grid.version = self.version
+        # pyramid tiles are validated against their signature so they can be shared
+        grid._levels = self._levels.copy()
+        # neither grid may write to a shared tile in place any more
+        self._owned = set()
+        return grid
+
+    def keys(self):
+        return self.tiles.keys()
+
+    def items(self):
+        return self.tiles.items()
+
+    def tile_version(self, key):
+        return self.versions.get(key, 0)
+
+    def tile_rect(self, key):
+        """
+        Return the (left, top, right, bottom) box covered by a tile.
+        """
+        x = key[0] * self.tile_size
+        y = key[1] * self.tile_size
+        return x, y, x + self.tile_size, y + self.tile_size
+
+    def keys_in_box(self, box):
+        """
+        Return the keys of all tiles, stored or not, which intersect a
+        (left, top, right, bottom) box.
+        """
+        left, top, right, bottom = box
+        if right <= left or bottom <= top:
+            return []
+        size = self.tile_size
+        return [
+            (tx, ty)
+            for ty in range(top // size, (bottom - 1) // size + 1)
+            for tx in range(left // size, (right - 1) // size + 1)
+        ]
+
+    def stored_keys_in_box(self, box):
+        """
+        Return the keys of the stored tiles which intersect a box, walking
+        whichever of the box or the stored tiles is smaller.
+        """
+        left, top, right, bottom = box
+        if right <= left or bottom <= top:
+            return []
+        size = self.tile_size
+        # count the tiles of the box before listing them, a huge box on a sparse grid has too many
+        count = ((right - 1) // size - left // size + 1) * ((bottom - 1) // size - top // size + 1)
+        if count <= len(self.tiles):
+            return [key for key in self.keys_in_box(box) if key in self.tiles]
+        return [
+            key for key in self.tiles
+            if key[0] * size < right and (key[0] + 1) * size > left
+            and key[1] * size < bottom and (key[1] + 1) * size > top
+        ]
+
+    def bbox(self):
+        """
+        Return the (left, top, right, bottom) box of all stored tiles or None.
+        """
+        if not self.tiles:
+            return None
+        xs = [key[0] for key in self.tiles]
+        ys = [key[1] for key in self.tiles]
+        size = self.tile_size
+        return min(xs) * size, min(ys) * size, (max(xs) + 1) * size, (max(ys) + 1) * size
+
+    def touch(self, key=None):
+        """
+        Give a tile (or all tiles) a new version.
+        """
+        keys = [key] if key is not None else list(self.tiles.keys())
+        for key in keys:
+            self.versions[key] = next(_versions)
+        self.version = next(_versions)
+
+    def clear(self):
+        self.tiles = {}
+        self.versions = {}
+        self._owned = set()
+        self.version = next(_versions)
+
+    def get_tile(self, key):
+        return self.tiles.get(key)
+
+    def set_tile(self, key, tile):
+        """
+        Replace a tile, passing None or a fully transparent tile removes it.
+        """
+        if tile is None or tile.getchannel("A").getbbox() is None:
+            self.tiles.pop(key, None)
+            self.versions.pop(key, None)
+            self._owned.discard(key)
+        else:
+            self.tiles[key] = tile
+            self._owned.add(key)
+            self.versions[key] = next(_versions)
+        self.version = next(_versions)
+
+    def writable_tile(self, key):
+        """
+        Return a tile which may be modified in place, creating it if needed.
+        Call set_tile or touch after modifying it.
+        """
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = Image.new("RGBA", (self.tile_size, self.tile_size), (0, 0, 0, 0))
+        elif key not in self._owned:
+            tile = tile.copy()
+        self.tiles[key] = tile
+        self._owned.add(key)
+        return tile
+
+    def paste(self, image, position, mode="replace"):
+        """
+        Paste an image with its top left corner at position.
+
+        mode "replace" overwrites the pixels, "over" composites the image on
+        top of the existing pixels and "under" composites it below them.
+        """
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        x, y = int(position[0]), int(position[1])
+        box = (x, y, x + image.width, y + image.height)
+        for key in self.keys_in_box(box):
+            tile_left, tile_top, tile_right, tile_bottom = self.tile_rect(key)
+            left = max(box[0], tile_left)
+            top = max(box[1], tile_top)
+            right = min(box[2], tile_right)
+            bottom = min(box[3], tile_bottom)
+            region = image.crop((left - x, top - y, right - x, bottom - y))
+            existing = self.tiles.get(key)
+            if existing is None and region.getchannel("A").getbbox() is None:
+                continue
+            if existing is None and mode != "replace":
+                mode_for_tile = "replace"
+            else:
+                mode_for_tile = mode
+            tile = self.writable_tile(key)
+            dest = (left - tile_left, top - tile_top)
+            if mode_for_tile == "replace":
+                tile.paste(region, dest)
+            elif mode_for_tile == "over":
+                tile.alpha_composite(region, dest)
+            else:
+                below = region.copy()
+                below.alpha_composite(tile.crop((dest[0], dest[1], dest[0] + region.width, dest[1] + region.height)))
+                tile.paste(below, dest)
+            self.set_tile(key, tile)
+
+    def snapshot(self, keys):
+        """
+        Return {key: tile or None} for keys. The tiles are no longer written
+        in place, so the snapshot stays valid without copying any pixels.
+        """
+        for key in keys:
+            self._owned.discard(key)
+        return {key: self.tiles.get(key) for key in keys}
+
+    def restore(self, snapshot):
+        """
+        Put back the tiles of a snapshot and return a snapshot of the tiles
+        they replaced.
+        """
+        previous = self.snapshot(snapshot.keys())
+        for key, tile in snapshot.items():
+            self.set_tile(key, tile)
+            self._owned.discard(key)
+        return previous
+
+    def erase_ellipse(self, box):
+        """
+        Make the pixels inside the ellipse bounded by a (left, top, right,
+        bottom) box transparent, in place in the tiles it covers.
+        """
+        for key in self.stored_keys_in_box((box[0], box[1], box[2] + 1, box[3] + 1)):
+            tile_left, tile_top, _, _ = self.tile_rect(key)
+            tile = self.writable_tile(key)
+            ImageDraw.Draw(tile).ellipse(
+                (box[0] - tile_left, box[1] - tile_top, box[2] - tile_left, box[3] - tile_top),
+                fill=(0, 0, 0, 0)
+            )
+            self.set_tile(key, tile)
+
+    def crop(self, box):
+        """
+        Return the pixels inside a (left, top, right, bottom) box as an RGBA
+        image, only the tiles which intersect the box are read.
+        """
+        left, top, right, bottom = (int(v) for v in box)
+        image = Image.new("RGBA", (max(0, right - left), max(0, bottom - top)), (0, 0, 0, 0))
+        for key in self.stored_keys_in_box((left, top, right, bottom)):
+            tile = self.tiles[key]
+            tile_left, tile_top, _, _ = self.tile_rect(key)
+            image.paste(tile, (tile_left - left, tile_top - top))
+        return image
+
+    def crop_level(self, level, box):
+        """
+        Return the pixels inside a box of full resolution coordinates at the
+        1/2 ** level scale of a pyramid level, from the level tiles. The box
+        should be aligned to 2 ** level pixels.
+        """
+        if level == 0:
+            return self.crop(box)
+        left, top, right, bottom = (int(v) >> level for v in box)
+        image = Image.new("RGBA", (max(0, right - left), max(0, bottom - top)), (0, 0, 0, 0))
+        size = self.tile_size
+        for key in self.level_keys_in_box(level, box):
+            tile = self.level_tile(level, key)
+            if tile is not None:
+                image.paste(tile, (key[0] * size - left, key[1] * size - top))
+        return image
+
+    def level_keys_in_box(self, level, box):
+        """
+        Return the keys of the level tiles which intersect a box and cover at
+        least one stored tile.
+        """
+        if level == 0:
+            return self.stored_keys_in_box(box)
+        size = self.tile_size << level
+        left, top, right, bottom = box
+        if right <= left or bottom <= top:
+            return []
+        stored = {(tx >> level, ty >> level) for tx, ty in self.tiles}
+        return [
+            (tx, ty)
+            for ty in range(top // size, (bottom - 1) // size + 1)
+            for tx in range(left // size, (right - 1) // size + 1)
+            if (tx, ty) in stored
+        ]
+
+    def level_signature(self, level, key):
+        """
+        Return a value which changes whenever any tile under a level tile
+        changes. Versions only ever increase (loaded grids get new ones) so
+        the highest version and the number of tiles are enough to notice
+        writes and removals.
+        """
+        if level == 0:
+            return self.versions.get(key, 0)
+        size = self.tile_size << level
+        box = (key[0] * size, key[1] * size, (key[0] + 1) * size, (key[1] + 1) * size)
+        versions = [self.versions[child] for child in self.stored_keys_in_box(box)]
+        return max(versions, default=0), len(versions)
+
+    def level_tile(self, level, key):
+        """
+        Return the tile of the mip pyramid at level (1/2 ** level scale) as a
+        tile_size image, or None if nothing is stored under it. Level tiles
+        are built lazily from the level below and rebuilt only when one of
+        the tiles they cover changes.
+        """
+        if level == 0:
+            return self.tiles.get(key)
+        signature = self.level_signature(level, key)
+        if signature[1] == 0:
+            self._levels.pop((level, key), None)
+            return None
+        cached = self._levels.get((level, key))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        size = self.tile_size
+        image = Image.new("RGBA", (size * 2, size * 2), (0, 0, 0, 0))
+        for y in range(2):
+            for x in range(2):
+                child = self.level_tile(level - 1, (key[0] * 2 + x, key[1] * 2 + y))
+                if child is not None:
+                    image.paste(child, (x * size, y * size))
+        image = image.reduce(2)
+        self._levels[(level, key)] = (signature, image)
+        return image
+
+    def nbytes(self):
+        return sum(tile.width * tile.height * 4 for tile in self.tiles.values())
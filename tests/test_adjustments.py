@@ -0,0 +1,30 @@
+from PIL import Image, ImageFilter
+from PyQt6.QtCore import QPoint
+from generate_input import GenerateInput
+from qtcanvas import ImageData, LayerData
+
+
+def make_layer():
+    layer = LayerData(0, "Layer 1")
+    image = Image.new("RGBA", (300, 200), (0, 0, 255, 255))
+    image.paste((255, 255, 0, 255), (0, 0, 150, 200))
+    layer.images = [ImageData(QPoint(0, 0), image)]
+    layer.adjustments.add(ImageFilter.GaussianBlur(8))
+    return layer, image.filter(ImageFilter.GaussianBlur(8))
+
+
+def test_saved_layer_contains_adjusted_pixels(tmp_path):
+    layer, expected = make_layer()
+    path = tmp_path / "layer.png"
+    layer.flattened_image().image.save(path)
+    saved = Image.open(path).convert("RGBA")
+    assert saved.tobytes() == expected.tobytes()
+    # the layer image itself is left unfiltered
+    assert layer.image.image.getpixel((149, 100)) == (255, 255, 0, 255)
+
+
+def test_generate_input_contains_adjusted_pixels():
+    layer, expected = make_layer()
+    generate_input = GenerateInput(layer, (0, 0, 300, 200), (300, 200))
+    prepared = generate_input.prepare()
+    assert prepared["image"].tobytes() == expected.convert("RGB").tobytes()